@@ -3,19 +3,38 @@ A hook into setuptools for Git.
 """
 import sys
 import os
+import time
+import errno
+import marshal
 import posixpath
 
+from bisect import bisect_left
 from os.path import realpath, join
 from subprocess import PIPE
+from subprocess import Popen
 
 from setuptools_git.utils import check_output
 from setuptools_git.utils import b
 from setuptools_git.utils import posix
 from setuptools_git.utils import fsdecode
 from setuptools_git.utils import hfs_quote
-from setuptools_git.utils import compose
 from setuptools_git.utils import decompose
 from setuptools_git.utils import CalledProcessError
+from setuptools_git.cache import readfile
+from setuptools_git.cache import commondir
+from setuptools_git.cache import memo
+from setuptools_git.cache import disk
+from setuptools_git.cache import readhead
+from setuptools_git.cache import indexstat
+from setuptools_git.cache import tagstate
+from setuptools_git import trace
+from setuptools_git import scan
+
+# Every setuptools run loads this module through its entry points, so
+# modules that only some functions need are imported where used
+
+# Calls to calculate_version and the time they took
+versionstats = {'calls': 0, 'seconds': 0.0}
 
 
 def version_calc(dist, attr, value):
@@ -24,11 +43,89 @@ def version_calc(dist, attr, value):
     bool(value) should be true to invoke this plugin.
     """
     if attr == 'use_vcs_version' and value:
+        import logging
+        seconds = versionstats['seconds']
         dist.metadata.version = calculate_version()
+        logging.getLogger(__name__).info(
+            'setuptools-git: calculated version %s in %.3fs',
+            dist.metadata.version, versionstats['seconds'] - seconds)
 
 
 def calculate_version():
-    return check_output(['git', 'describe', '--tags', '--dirty']).strip()
+    # 'git describe --dirty' refreshes the index and looks at every file
+    # in the work tree, which takes long in large checkouts. Setting
+    # SETUPTOOLS_GIT_DIRTY=0 leaves the check out. Either way the
+    # result is cached until HEAD, the index or the tags change. With
+    # SETUPTOOLS_GIT_REVISION set, that commit is described instead.
+    start = time.time()
+    try:
+        return _describe(_dirty())
+    finally:
+        versionstats['calls'] += 1
+        versionstats['seconds'] += time.time() - start
+
+
+def _dirty():
+    return os.environ.get('SETUPTOOLS_GIT_DIRTY', '1') != '0'
+
+
+def _describeargs(dirty, commit=None):
+    args = ['git', 'describe', '--tags']
+    if commit is not None:
+        # A commit has no work tree to be dirty
+        args.append(commit)
+    elif dirty:
+        args.append('--dirty')
+    return args
+
+
+def _describekey(gitdir):
+    return (readhead(gitdir), indexstat(gitdir), tagstate(gitdir))
+
+
+def _describe(dirty, dirname=''):
+    revision = _revision()
+    cwd = dirname or None
+    try:
+        topdir, gitdir = _gitrepo(dirname)
+    except OSError:
+        # Not a repository, let Git say so
+        return check_output(_describeargs(dirty, revision), cwd=cwd).strip()
+
+    if revision is None:
+        args = _describeargs(dirty)
+        slot, key = ('describe', dirty), _describekey
+    else:
+        # How a commit is described only changes with the tags
+        commit = _commit(cwd, gitdir, revision)
+        args = _describeargs(dirty, commit)
+        slot, key = ('describe', commit), tagstate
+
+    def describe():
+        with trace.phase('describe', dirty=dirty):
+            return check_output(args, cwd=cwd, env=_gitenv(gitdir))
+
+    def compute():
+        if dirty and revision is None:
+            # Edits to tracked files make the work tree dirty without
+            # changing anything the disk cache is keyed on
+            return describe().strip()
+        return disk(gitdir, slot, describe, key).strip()
+
+    return memo(gitdir, slot + (tagstate(gitdir),), compute)
+
+
+def _revision():
+    # The commit or tag to package instead of the work tree, if any
+    return os.environ.get('SETUPTOOLS_GIT_REVISION') or None
+
+
+def _commit(cwd, gitdir, revision):
+    # The object id of the commit revision names, so that what is
+    # cached for it cannot go stale when a branch or tag moves
+    return check_output(
+        ['git', 'rev-parse', '--verify', '--quiet', revision + '^{commit}'],
+        cwd=cwd, stderr=PIPE, env=_gitenv(gitdir)).strip().decode('ascii')
 
 
 def ntfsdecode(path):
@@ -46,6 +143,545 @@ def ntfsdecode(path):
     return path
 
 
+def _pathdecoder(platform=None):
+    # Return a function that turns a list of paths relative to the
+    # toplevel, as returned by Git, into absolute paths in the form the
+    # file system uses. The platform is looked at once, here, and ASCII
+    # names, which need neither quoting nor normalization, skip the
+    # per-platform handling in setuptools_git.utils altogether.
+    if platform is None:
+        platform = sys.platform
+
+    if platform == 'win32':
+        slow = ntfsdecode
+    elif platform == 'darwin':
+        def slow(path):
+            return decompose(fsdecode(hfs_quote(path)))
+    else:
+        slow = fsdecode
+
+    if sys.version_info < (3,):
+        def decode(prefix, filenames):
+            return [slow(prefix + filename) for filename in filenames]
+        return decode
+
+    isascii = getattr(bytes, 'isascii', None)
+    if isascii is None:
+        def isascii(path):  # Python < 3.7
+            try:
+                path.decode('ascii')
+            except UnicodeDecodeError:
+                return False
+            return True
+
+    def decode(prefix, filenames):
+        head = slow(prefix)
+        if head + 'x' != slow(prefix + b('x')):
+            # The prefix needs quoting; everything takes the long way
+            return [slow(prefix + filename) for filename in filenames]
+        return [head + filename.decode('ascii') if isascii(filename)
+                else slow(prefix + filename) for filename in filenames]
+
+    return decode
+
+
+_decode = _pathdecoder()
+
+
+def _splitpaths(blob, nul=b('\x00')):
+    # Split NUL separated output of Git, dropping the empty tail
+    filenames = blob.split(nul)
+    if filenames and not filenames[-1]:
+        filenames.pop()
+    return filenames
+
+
+def _isgitdir(path):
+    # The same test Git applies before it accepts a Git directory
+    return (os.path.isfile(join(path, 'HEAD')) and
+            (os.path.isdir(join(path, 'objects')) or
+             os.path.isfile(join(path, 'commondir'))))
+
+
+def _readgitfile(path):
+    # Submodules and linked work trees have a .git file pointing to
+    # their Git directory elsewhere
+    fd = open(path, 'rb')
+    try:
+        line = fd.readline().strip()
+    finally:
+        fd.close()
+    if not line.startswith(b('gitdir: ')):
+        return None
+    gitdir = line[8:]
+    if sys.platform == 'win32':
+        gitdir = ntfsdecode(gitdir)
+    else:
+        gitdir = fsdecode(gitdir)
+    return realpath(join(os.path.dirname(path), gitdir))
+
+
+def _worktreeconfig(gitdir, topdir):
+    # Whether the config moves the work tree away from topdir, or says
+    # there is none. Submodules point core.worktree back at their own
+    # directory, which is fine.
+    import re
+    config = readfile(join(commondir(gitdir), 'config'))
+    if config is None:
+        return False
+    if re.search(b(r'^\s*bare\s*=\s*true\s*$'), config,
+                 re.MULTILINE | re.IGNORECASE):
+        return True
+    for worktree in re.findall(b(r'^\s*worktree\s*=\s*(.*?)\s*$'), config,
+                               re.MULTILINE | re.IGNORECASE):
+        if sys.platform == 'win32':
+            worktree = ntfsdecode(worktree)
+        else:
+            worktree = fsdecode(worktree)
+        if realpath(join(gitdir, worktree)) != topdir:
+            return True
+    return False
+
+
+def _configmatch(pattern, *configs):
+    # Whether pattern matches a line of one of the config files
+    import re
+    for config in configs:
+        if config and re.search(pattern, config,
+                                re.MULTILINE | re.IGNORECASE):
+            return True
+    return False
+
+
+def _sparse(gitdir):
+    # Whether the work tree is a sparse checkout. Its index then has
+    # entries with the skip-worktree bit, which are not on disk. Work
+    # trees can turn sparse checkout on in their own config.
+    return _configmatch(
+        b(r'^\s*sparsecheckout\s*=\s*(true|yes|on|1)\s*$'),
+        readfile(join(commondir(gitdir), 'config')),
+        readfile(join(gitdir, 'config.worktree')))
+
+
+def _partialclone(gitdir):
+    # Whether the repository is a partial clone, whose missing objects
+    # Git fetches from a promisor remote the first time it needs them
+    return _configmatch(
+        b(r'^\s*(partialclone\s*=|promisor\s*=\s*(true|yes|on|1)\s*$)'),
+        readfile(join(commondir(gitdir), 'config')))
+
+
+def _gitenv(gitdir):
+    # The environment to run Git in, None for ours. Finding files and
+    # the version never needs the contents of files, so in a partial
+    # clone Git is told not to fetch objects rather than block on, or
+    # fail without, the network. Git before 2.44 ignores this.
+    if not _partialclone(gitdir):
+        return None
+    env = dict(os.environ)
+    env['GIT_NO_LAZY_FETCH'] = '1'
+    return env
+
+
+def _findgitdir(dirname):
+    # Return the toplevel and the Git directory of the work tree
+    # containing dirname, or None where the environment or the config
+    # make Git find them differently
+    for name in ('GIT_DIR', 'GIT_WORK_TREE', 'GIT_CEILING_DIRECTORIES'):
+        if name in os.environ:
+            return None
+
+    topdir = realpath(dirname or os.curdir)
+    across = os.environ.get('GIT_DISCOVERY_ACROSS_FILESYSTEM', '')
+    device = os.stat(topdir).st_dev
+    while True:
+        dotgit = join(topdir, '.git')
+        gitdir = None
+        if os.path.isdir(dotgit):
+            gitdir = dotgit
+        elif os.path.isfile(dotgit):
+            gitdir = _readgitfile(dotgit)
+        if gitdir is not None and _isgitdir(gitdir):
+            if _worktreeconfig(gitdir, topdir):
+                return None
+            return topdir, gitdir
+
+        parent = os.path.dirname(topdir)
+        if parent == topdir or (
+                across.lower() not in ('1', 'true', 'yes', 'on') and
+                os.stat(parent).st_dev != device):
+            raise OSError(errno.ENOENT, 'Not a git repository', dirname)
+        topdir = parent
+
+
+def _fsencode(path):
+    if sys.platform == 'win32':
+        # Git spells paths with forward slashes and in UTF-8
+        path = posix(path)
+        if sys.version_info >= (3,):
+            path = path.encode('utf-8')
+        return path
+    if sys.version_info >= (3,):
+        return os.fsencode(path)
+    return path
+
+
+def _gitrepo(dirname):
+    # Return the toplevel of the work tree containing dirname, as Git
+    # spells it, and the absolute path of its Git directory. They are
+    # found without running Git whenever possible.
+    with trace.phase('discover', git=False) as phase:
+        found = _findgitdir(dirname)
+        if found is not None:
+            topdir, gitdir = found
+            return _fsencode(topdir), gitdir
+
+        phase.update(git=True)
+        topdir, gitdir = check_output(
+            ['git', 'rev-parse', '--show-toplevel', '--git-dir'],
+            cwd=dirname or None, stderr=PIPE).splitlines()[:2]
+
+    if sys.platform == 'win32':
+        gitdir = ntfsdecode(gitdir)
+    else:
+        gitdir = fsdecode(gitdir)
+    return topdir, os.path.abspath(join(dirname or os.curdir, gitdir))
+
+
+def _lsfilesargs(topdir, args, scope=None):
+    # The directory to run 'git ls-files' in and the arguments to add:
+    # the top of the work tree, or the scope directory to only list the
+    # files below it
+    if scope is not None:
+        return scope, ['--full-name'] + args
+    if sys.platform == 'win32':
+        return ntfsdecode(topdir), args
+    return topdir, args
+
+
+def _gitlsfiles(topdir, gitdir, args, scope=None):
+    # Run 'git ls-files -z' with extra args, see _lsfilesargs
+    cwd, args = _lsfilesargs(topdir, args, scope)
+
+    def compute():
+        if os.environ.get('SETUPTOOLS_GIT_BACKEND') == 'python':
+            from setuptools_git import index
+            prefix = None
+            if scope is not None:
+                prefix = _fsencode(scope)[len(topdir) + 1:]
+            try:
+                with trace.phase('read-index', args=args) as phase:
+                    res = index.lsfiles(gitdir, '--stage' in args, prefix,
+                                        '-t' in args)
+                    phase.update(bytes=len(res))
+                return res
+            except (index.UnsupportedIndex, IOError, OSError):
+                pass  # Let Git sort it out
+        with trace.phase('ls-files', args=args) as phase:
+            res = check_output(
+                ['git', 'ls-files', '-z'] + args, cwd=cwd, stderr=PIPE,
+                env=_gitenv(gitdir))
+            phase.update(bytes=len(res))
+        return res
+
+    return disk(gitdir, ('ls-files', topdir, scope) + tuple(args), compute)
+
+
+def _exportignore():
+    return os.environ.get('SETUPTOOLS_GIT_EXPORT_IGNORE', '0') == '1'
+
+
+def _exportignored(topdir, gitdir, paths, commit=None):
+    # Return those of paths, as Git spells them, that 'git archive'
+    # leaves out: the ones with the export-ignore attribute and the
+    # ones in a directory with it. A single 'git check-attr' answers
+    # for all paths and their directories. Attributes are read from
+    # the index, which is what the caches are keyed on, or from
+    # commit when given, as 'git archive' does.
+    if not paths:
+        return set()
+    dirs = set()
+    for path in paths:
+        dir = posixpath.dirname(path)
+        while dir and dir not in dirs:
+            dirs.add(dir)
+            dir = posixpath.dirname(dir)
+
+    with trace.phase('check-attr', paths=len(paths) + len(dirs),
+                     helper=_helpers()) as phase:
+        # The output reads '<path>\0export-ignore\0<value>\0' per path
+        fields = _checkattr(topdir, gitdir, sorted(dirs) + list(paths),
+                            commit)
+        ignored = set(fields[i] for i in range(0, len(fields) - 2, 3)
+                      if fields[i + 2] == b('set'))
+        res = set()
+        if ignored:
+            for path in paths:
+                dir = path
+                while dir:
+                    if dir in ignored:
+                        res.add(path)
+                        break
+                    dir = posixpath.dirname(dir)
+        phase.update(ignored=len(res))
+    return res
+
+
+def _helpers():
+    return os.environ.get('SETUPTOOLS_GIT_HELPERS', '0') == '1'
+
+
+def _checkattr(topdir, gitdir, paths, commit=None):
+    # The output of 'git check-attr' for the export-ignore attribute of
+    # paths, split at NULs. With SETUPTOOLS_GIT_HELPERS=1 a long-running
+    # Git answers, see setuptools_git.helpers.
+    if sys.platform == 'win32':
+        cwd = ntfsdecode(topdir)
+    else:
+        cwd = topdir
+    args = ['git', 'check-attr', '--cached', '--stdin', '-z', 'export-ignore']
+    env = _gitenv(gitdir)
+    if commit is not None:
+        # Git before 2.40 cannot read attributes from a commit, but it
+        # reads them from an index made of its tree. Helpers are keyed
+        # on the real index and are not used for this.
+        import shutil
+        import tempfile
+        directory = tempfile.mkdtemp(prefix='setuptools-git-')
+        try:
+            env = dict(env or os.environ)
+            env['GIT_INDEX_FILE'] = join(directory, 'index')
+            with trace.phase('read-tree', commit=commit):
+                check_output(['git', 'read-tree', commit], cwd=cwd,
+                             stderr=PIPE, env=env)
+            return _runcheckattr(args, cwd, paths, env)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+    if _helpers():
+        from setuptools_git import helpers
+        try:
+            return helpers.query(args, cwd, gitdir, paths, 3, env)
+        except (IOError, OSError):
+            pass  # Start a Git of our own instead
+    return _runcheckattr(args, cwd, paths, env)
+
+
+def _runcheckattr(args, cwd, paths, env):
+    # Run 'git check-attr --stdin -z' once for paths
+    nul = b('\x00')
+    devnull = open(os.devnull, 'wb')
+    try:
+        process = Popen(args, cwd=cwd, stdin=PIPE, stdout=PIPE,
+                        stderr=devnull, env=env)
+    finally:
+        devnull.close()
+    output = process.communicate(nul.join(paths) + nul)[0]
+    if process.returncode:
+        raise CalledProcessError(process.returncode, args)
+    return _splitpaths(output)
+
+
+def _topprefix(topdir):
+    # The toplevel as the decoded paths spell it, with a trailing slash
+    return _decode(posixpath.join(topdir, b('')), [b('')])[0]
+
+
+class _PathTable(object):
+    # A set of absolute paths in POSIX form, kept as a table from each
+    # directory to the names of the paths in it, so that the long
+    # common part of paths is stored once per directory rather than
+    # once per path. The names are kept in sorted tuples, which take
+    # a fraction of the memory of sets and are searched by bisection.
+    # The directories below the first prefix_length characters that
+    # hold paths, directly or further down, are in dirs, which shares
+    # its strings with the table.
+
+    def __init__(self, paths=(), prefix_length=0):
+        names = {}
+        dirs = set()
+        for path in paths:
+            dir, _, name = path.rpartition('/')
+            entry = names.get(dir)
+            if entry is None:
+                entry = names[dir] = []
+                _ancestors(dirs, dir, prefix_length)
+            entry.append(name)
+        for dir in names:
+            names[dir] = tuple(sorted(names[dir]))
+        self.names = names
+        self.dirs = dirs
+
+    def __contains__(self, path):
+        dir, _, name = path.rpartition('/')
+        entry = self.names.get(dir)
+        if entry is None:
+            return False
+        i = bisect_left(entry, name)
+        return i < len(entry) and entry[i] == name
+
+    def __iter__(self):
+        for dir, entry in self.names.items():
+            dir += '/'
+            for name in entry:
+                yield dir + name
+
+    def __len__(self):
+        return sum(len(entry) for entry in self.names.values())
+
+
+def _tagargs(gitdir, args):
+    # The arguments to list files with and whether they make 'git
+    # ls-files' tag entries, which it does in sparse checkouts to tell
+    # those that are not checked out
+    if _sparse(gitdir):
+        return args + ['-t'], True
+    return args, False
+
+
+def _materialized(entries, skipped=b('S ')):
+    # The entries of 'git ls-files -t' that are checked out, untagged.
+    # Sparse checkouts leave out the skip-worktree entries.
+    return [entry[2:] for entry in entries if entry[:2] != skipped]
+
+
+def _gitfiles(topdir, gitdir, scope=None):
+    args, tagged = _tagargs(gitdir, [])
+    return _filetable(topdir, gitdir,
+                      _gitlsfiles(topdir, gitdir, args, scope), tagged)
+
+
+def _filetable(topdir, gitdir, blob, tagged=False):
+    # The files in the output of 'git ls-files -z', with -t if tagged
+    prefix = posixpath.join(topdir, b(''))
+    filenames = _splitpaths(blob)
+    skipped = 0
+    if tagged:
+        count = len(filenames)
+        filenames = _materialized(filenames)
+        skipped = count - len(filenames)
+    if _exportignore():
+        ignored = _exportignored(topdir, gitdir, filenames)
+        filenames = [x for x in filenames if x not in ignored]
+    with trace.phase('decode', paths=len(filenames), skipped=skipped):
+        return _PathTable(_decode(prefix, filenames),
+                          len(_topprefix(topdir)))
+
+
+def _gitmodes(topdir, gitdir, scope=None):
+    # Like _gitfiles, but also return the subsets of symbolic links
+    # and submodules, using the modes recorded in the index
+    args, tagged = _tagargs(gitdir, ['--stage'])
+    return _modetable(topdir, gitdir,
+                      _gitlsfiles(topdir, gitdir, args, scope), tagged)
+
+
+def _modetable(topdir, gitdir, blob, tagged=False):
+    # The files, symbolic links and submodules in the output of
+    # 'git ls-files -z --stage', with -t if tagged
+    symlinks, gitlinks = set(), set()
+
+    # Each entry reads '<mode> <object> <stage>\t<file>'
+    prefix = posixpath.join(topdir, b(''))
+    tab, symlink, gitlink = b('\t'), b('120000'), b('160000')
+    entries = _splitpaths(blob)
+    skipped = 0
+    if tagged:
+        count = len(entries)
+        entries = _materialized(entries)
+        skipped = count - len(entries)
+    paths = [entry.partition(tab)[2] for entry in entries]
+    if _exportignore():
+        ignored = _exportignored(topdir, gitdir, paths)
+        entries = [entry for entry, path in zip(entries, paths)
+                   if path not in ignored]
+        paths = [path for path in paths if path not in ignored]
+    with trace.phase('decode', paths=len(entries), skipped=skipped):
+        filenames = _decode(prefix, paths)
+        for entry, filename in zip(entries, filenames):
+            if entry[:6] == symlink:
+                symlinks.add(filename)
+            elif entry[:6] == gitlink:
+                gitlinks.add(filename)
+        return set(filenames), symlinks, gitlinks
+
+
+def _submodules():
+    return os.environ.get('SETUPTOOLS_GIT_SUBMODULES', '0') == '1'
+
+
+def _jobs():
+    # How many Git processes to wait for at once
+    try:
+        return max(int(os.environ.get('SETUPTOOLS_GIT_JOBS', '8')), 1)
+    except ValueError:
+        return 8
+
+
+def _map(function, items):
+    # Call function for all items in a bounded pool of threads; the
+    # work is mostly waiting for Git
+    try:
+        from concurrent.futures import ThreadPoolExecutor
+    except ImportError:
+        ThreadPoolExecutor = None  # Python 2 without the futures backport
+    jobs = min(_jobs(), len(items))
+    if ThreadPoolExecutor is None or jobs < 2:
+        return [function(item) for item in items]
+    pool = ThreadPoolExecutor(max_workers=jobs)
+    try:
+        return list(pool.map(function, items))
+    finally:
+        pool.shutdown()
+
+
+def _gitsubmodule(path):
+    # Return the modes of an initialized submodule, None otherwise
+    if not os.path.exists(join(path, '.git')):
+        return None
+    try:
+        topdir, gitdir = _gitrepo(path)
+        return _load(topdir, gitdir, _gitmodes, submodules=False)
+    except (CalledProcessError, OSError):
+        return None
+
+
+def _slot(topdir, query, scope):
+    # Where the result of query goes in the memo
+    return (topdir, query.__name__, scope, _exportignore())
+
+
+def _load(topdir, gitdir, query, scope=None, submodules=None):
+    # Return the result of query for the work tree, cached, and with
+    # SETUPTOOLS_GIT_SUBMODULES=1 merged with those of the initialized
+    # submodules in it. The submodules of each level of nesting are
+    # listed concurrently.
+    def load(query):
+        return memo(gitdir, _slot(topdir, query, scope),
+                    lambda: query(topdir, gitdir, scope))
+
+    if submodules is None:
+        submodules = _submodules()
+    if not submodules:
+        return load(query)
+
+    files, symlinks, gitlinks = [set(x) for x in load(_gitmodes)]
+    pending = sorted(gitlinks)
+    while pending:
+        with trace.phase('submodules', count=len(pending)):
+            results = _map(_gitsubmodule, pending)
+        pending = []
+        for modes in results:
+            if modes is not None:
+                files.update(modes[0])
+                symlinks.update(modes[1])
+                gitlinks.update(modes[2])
+                pending.extend(sorted(modes[2]))
+
+    if query is _gitfiles:
+        return _PathTable(files, len(_topprefix(topdir)))
+    return files, symlinks, gitlinks
+
+
 def gitlsfiles(dirname=''):
     # NB: Passing the '-z' option to 'git ls-files' below returns the
     # output as a blob of null-terminated filenames without canonical-
@@ -60,81 +696,582 @@ def gitlsfiles(dirname=''):
     # '"pyramid/tests/fixtures/static/h\\303\\251h\\303\\251.html"'
     #
     # for each file.
-    res = set()
-
     try:
-        topdir = check_output(
-            ['git', 'rev-parse', '--show-toplevel'], cwd=dirname or None,
-            stderr=PIPE).strip()
+        topdir, gitdir = _gitrepo(dirname)
+        res = _load(topdir, gitdir, _gitfiles)
+    except (CalledProcessError, OSError):
+        # Setuptools mandates we fail silently
+        return set()
+
+    # The cache keeps the paths in a compact table, hand out a set
+    return set(res)
+
 
+def itergitlsfiles(dirname='', bufsize=65536):
+    # Like gitlsfiles, but read the output of 'git ls-files' in chunks
+    # of bufsize bytes and yield the paths one at a time, so memory use
+    # does not grow with the size of the repository. Nothing is cached.
+    # With SETUPTOOLS_GIT_EXPORT_IGNORE=1, each chunk is filtered by a
+    # 'git check-attr' of its own. With SETUPTOOLS_GIT_SUBMODULES=1,
+    # the files of each initialized submodule follow, one after the
+    # other.
+    submodules = _submodules()
+    try:
+        topdir, gitdir = _gitrepo(dirname)
         if sys.platform == 'win32':
             cwd = ntfsdecode(topdir)
         else:
             cwd = topdir
+        args = ['git', 'ls-files', '-z']
+        if submodules:
+            args.append('--stage')
+        args, tagged = _tagargs(gitdir, args)
+        devnull = open(os.devnull, 'wb')
+        try:
+            process = Popen(args, cwd=cwd, stdout=PIPE, stderr=devnull,
+                            env=_gitenv(gitdir))
+        finally:
+            devnull.close()
+    except (CalledProcessError, OSError):
+        # Setuptools mandates we fail silently
+        return
+
+    prefix = posixpath.join(topdir, b(''))
+    nul = b('\x00')
+    pending = b('')
+    exportignore = _exportignore()
+    # Each entry reads '<mode> <object> <stage>\t<file>' with --stage
+    tab, gitlink = b('\t'), b('160000')
+    gitlinks = []
+    try:
+        while True:
+            chunk = process.stdout.read(bufsize)
+            if not chunk:
+                break
+            filenames = (pending + chunk).split(nul)
+            pending = filenames.pop()
+            if tagged:
+                filenames = _materialized(filenames)
+            if submodules:
+                gitlinks.extend(entry.partition(tab)[2] for entry in filenames
+                                if entry[:6] == gitlink)
+                filenames = [entry.partition(tab)[2] for entry in filenames]
+            if exportignore and filenames:
+                try:
+                    ignored = _exportignored(topdir, gitdir, filenames)
+                except (CalledProcessError, OSError):
+                    # Setuptools mandates we fail silently
+                    return
+                filenames = [x for x in filenames if x not in ignored]
+                gitlinks = [x for x in gitlinks if x not in ignored]
+            for filename in _decode(prefix, filenames):
+                yield filename
+    finally:
+        process.stdout.close()
+        process.wait()
+
+    for path in _decode(prefix, gitlinks):
+        if os.path.exists(join(path, '.git')):
+            for filename in itergitlsfiles(path, bufsize):
+                yield filename
+
+
+def _ancestors(dirs, dir, prefix_length):
+    # Add dir and the directories it is in, down to the first
+    # prefix_length characters, to the set dirs. Going up stops at the
+    # first directory already there, since those above it are as well.
+    while len(dir) > prefix_length and dir not in dirs:
+        dirs.add(dir)
+        dir = dir.rpartition('/')[0]
 
-        filenames = check_output(
-            ['git', 'ls-files', '-z'], cwd=cwd, stderr=PIPE)
+
+def gitlsdirs(dirname=''):
+    # Return the directories of the work tree containing dirname that
+    # hold files managed by Git, directly or further down, in the same
+    # form as gitlsfiles. The toplevel itself is not included.
+    try:
+        topdir, gitdir = _gitrepo(dirname)
+        res = _load(topdir, gitdir, _gitfiles)
     except (CalledProcessError, OSError):
         # Setuptools mandates we fail silently
-        return res
+        return set()
+    return set(res.dirs)
+
+
+class _Widening(object):
+    # A set of the paths below prefix, which widen() replaces by a set
+    # of all paths the first time something elsewhere is looked up
+
+    def __init__(self, prefix, paths, widen=None):
+        self.prefix = prefix
+        self.paths = paths
+        self.widen = widen
+
+    def __contains__(self, path):
+        if self.widen is not None and not path.startswith(self.prefix):
+            self.paths, self.widen = self.widen(), None
+        return path in self.paths
+
+
+class _Resolver(object):
+    # Resolve the paths met walking down from a real directory one
+    # component at a time: a path resolves to where its parent does
+    # plus its name, unless that name is a symbolic link. This takes
+    # one lstat per entry, where realpath takes one per component.
+
+    def __init__(self, top):
+        # Maps directories walked to their real path and parent
+        self.dirs = {top: (top, None)}
+        self.lstats = 0
+        self.realpaths = 0
+        # The symbolic links in the directory walked, where known
+        self.links = None
+
+    def resolve(self, root, name):
+        path = join(self.dirs[root][0], name)
+        if self.links is not None:
+            link = name in self.links
+        else:
+            self.lstats += 1
+            link = os.path.islink(path)
+        if link:
+            self.realpaths += 1
+            return realpath(path), True
+        return path, False
+
+    def descend(self, root, name, path, link):
+        # Remember a directory about to be walked, or return False for
+        # a link back to one of the directories it is in, whether walked
+        # or above the top of the walk
+        if link:
+            prefix = path.rstrip(os.sep) + os.sep
+            parent = root
+            while parent is not None:
+                real = self.dirs[parent][0]
+                if real == path or real.startswith(prefix):
+                    return False
+                parent = self.dirs[parent][1]
+        self.dirs[join(root, name)] = (path, root)
+        return True
+
+
+def _incremental():
+    return os.environ.get('SETUPTOOLS_GIT_INCREMENTAL', '0') == '1'
 
-    for filename in filenames.split(b('\x00')):
-        if filename:
-            filename = posixpath.join(topdir, filename)
-            if sys.platform == 'darwin':
-                filename = hfs_quote(filename)
-            if sys.platform == 'win32':
-                filename = ntfsdecode(filename)
+
+class _DirTable(object):
+    # The entries of directories, by real path, as an earlier walk
+    # found them. Adding, removing or renaming an entry changes the
+    # mtime of its directory, so as long as that stays the same the
+    # entries can be reused without listing the directory again.
+    # Directories changed in the last two seconds are not remembered,
+    # since another change within the same tick would not show.
+
+    def __init__(self, dirs=None):
+        self.dirs = dirs or {}
+        self.fresh = {}
+        self.start = time.time()
+        self.hits = 0
+        self.misses = 0
+        self.counters = scan.counters()
+
+    def listdir(self, path):
+        # Return the subdirectories, other entries and symbolic links
+        # in directory path, the same way os.walk sorts them
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return [], [], []
+        entry = self.dirs.get(path)
+        if entry is not None and entry[0] == mtime:
+            self.hits += 1
+        else:
+            self.misses += 1
+            entry = (mtime,) + scan.listdir(path, self.counters)
+        if mtime < self.start - 2:
+            self.fresh[path] = entry
+
+        # Where a link points can change without its directory changing
+        dirs, files, links = list(entry[1]), list(entry[2]), entry[3]
+        for name in links:
+            if os.path.isdir(join(path, name)):
+                dirs.append(name)
             else:
-                filename = fsdecode(filename)
-            if sys.platform == 'darwin':
-                filename = decompose(filename)
-            res.add(filename)
-    return res
+                files.append(name)
+        self.counters['stats'] += len(links)
+        return dirs, files, links
 
 
-def _gitlsdirs(files, prefix_length):
-    # Return directories managed by Git
-    dirs = set()
-    for file in files:
-        dir = posixpath.dirname(file)
-        while len(dir) > prefix_length:
-            dirs.add(dir)
-            dir = posixpath.dirname(dir)
-    return dirs
+def _loadtable(gitdir, cwd):
+    # The directory table kept in the disk cache directory by the last
+    # walk of cwd, if SETUPTOOLS_GIT_INCREMENTAL=1
+    if not _incremental():
+        return None
+    data = disk.load(disk.path(gitdir, ('dirs', cwd), sys.version_info[:2]))
+    dirs = None
+    if data:
+        try:
+            dirs = marshal.loads(data)
+        except (EOFError, ValueError, TypeError):
+            pass  # Written by a crashed process, start over
+    return _DirTable(dirs)
 
 
-def listfiles(dirname=''):
-    git_files = gitlsfiles(dirname)
-    if not git_files:
-        return
+def _savetable(gitdir, cwd, table):
+    if table.misses or len(table.fresh) != len(table.dirs):
+        disk.store(disk.path(gitdir, ('dirs', cwd), sys.version_info[:2]),
+                   marshal.dumps(table.fresh))
+
+
+def _walktable(top, resolver, table):
+    # Like os.walk(top, followlinks=True), listing directories through
+    # table and yielding the symbolic links of each as well
+    pending = [top]
+    while pending:
+        root = pending.pop()
+        dirs, files, links = table.listdir(resolver.dirs[root][0])
+        yield root, dirs, files, set(links)
+        pending.extend(join(root, x) for x in reversed(dirs))
 
+
+def _listfiles_walk(dirname, git_files, git_dirs, table=None):
     cwd = realpath(dirname or os.curdir)
     prefix_length = len(cwd) + 1
+    resolver = _Resolver(cwd)
+
+    counters = None
+    if table is not None:
+        walker = _walktable(cwd, resolver, table)
+        counters = table.counters
+    elif scan.scandir is not None:
+        # Entries that are neither tracked files nor directories with
+        # some in them are passed over by name, before their type is
+        # looked at and before any symbolic link is resolved
+        def wanted(root, name):
+            path = posix(join(resolver.dirs[root][0], name))
+            return path in git_files or path in git_dirs
+
+        counters = scan.counters()
+        walker = scan.walk(cwd, counters, wanted)
+    else:
+        if sys.version_info >= (2, 6):
+            walker = os.walk(cwd, followlinks=True)
+        else:
+            walker = os.walk(cwd)
+        walker = ((root, dirs, files, None) for root, dirs, files in walker)
+
+    walked = pruned = 0
+    with trace.phase('walk') as phase:
+        for root, dirs, files, links in walker:
+            resolver.links = links
+            keep = []
+            for x in dirs:
+                path, link = resolver.resolve(root, x)
+                if (posix(path) in git_dirs and
+                        resolver.descend(root, x, path, link)):
+                    keep.append(x)
+            walked += 1
+            pruned += len(dirs) - len(keep)
+            dirs[:] = keep
+            for file in files:
+                if posix(resolver.resolve(root, file)[0]) in git_files:
+                    yield join(root, file)[prefix_length:]
+        phase.update(directories=walked, pruned=pruned,
+                     lstats=resolver.lstats, realpaths=resolver.realpaths)
+        if counters is not None:
+            phase.update(entries=counters['entries'],
+                         skipped=counters['skipped'],
+                         stats=counters['stats'])
+        if table is not None:
+            phase.update(listed=table.misses, reused=table.hits)
+
+
+def _listfiles_index(dirname, modes, widen=None, ordered=None):
+    # Derive the result from the index alone. Only symbolic links are
+    # resolved on disk, since they are the one place where the work
+    # tree can make a path mean something else than it does to Git.
+    # Files deleted from the work tree are still listed; setuptools
+    # drops paths that do not exist when it writes the manifest.
+    #
+    # modes holds the files below dirname; widen() returns those of
+    # the whole work tree, for symbolic links that point elsewhere.
+    # ordered, if given, is the sorted list of the files in modes.
+    cwd = posix(realpath(dirname or os.curdir))
+    if ordered is None:
+        ordered = sorted(modes[0])
+    state = [modes, ordered, widen]
+    res = []
+
+    def expand(directory, relative, chain, links):
+        (git_files, symlinks, gitlinks), ordered = state[0], state[1]
+        # '0' sorts right after '/', which bounds the files below directory
+        start = bisect_left(ordered, directory + '/')
+        end = bisect_left(ordered, directory + '0', start)
+        offset = len(directory) + 1
+        for filename in ordered[start:end]:
+            if filename in symlinks:
+                name = relative + filename[offset:]
+                target = posix(realpath(filename))
+                if state[2] is not None and not target.startswith(cwd + '/'):
+                    modes = state[2]()
+                    state[:] = [modes, sorted(modes[0]), None]
+                    git_files = modes[0]
+                if target in git_files:
+                    res.append(name)
+                elif not [x for x in chain + links + [filename]
+                          if x == target or x.startswith(target + '/')]:
+                    # A link to a directory managed by Git; links to a
+                    # directory this link or one followed to get here
+                    # is in, or back up the chain, would make os.walk
+                    # loop forever, skip them
+                    expand(target, name + '/', chain + [target],
+                           links + [filename])
+            elif filename not in gitlinks:
+                res.append(relative + filename[offset:])
+
+    with trace.phase('index', symlinks=len(modes[1])) as phase:
+        expand(cwd, '', [cwd], [])
+        phase.update(paths=len(res))
+    if os.sep != '/':
+        res = [name.replace('/', os.sep) for name in res]
+    return res
+
+
+def _gittree(topdir, gitdir, commit, scope=None):
+    # The output of 'git ls-tree -r -z' for commit, for the whole tree
+    # or only below the scope directory
+    cwd, args = _lsfilesargs(topdir, [], scope)
+
+    def compute():
+        with trace.phase('ls-tree', args=args) as phase:
+            res = check_output(['git', 'ls-tree', '-r', '-z'] + args +
+                               [commit], cwd=cwd, stderr=PIPE,
+                               env=_gitenv(gitdir))
+            phase.update(bytes=len(res))
+        return res
+
+    # What a commit holds never changes
+    return disk(gitdir, ('ls-tree', topdir, scope, commit), compute,
+                lambda gitdir: None)
+
+
+def _listfiles_tree(topdir, gitdir, dirname, commit):
+    # Derive the result from commit alone, without looking at the work
+    # tree or the index. Symbolic links are listed as they are, the
+    # way 'git archive' stores them, and submodules are left out.
+    cwd = realpath(dirname or os.curdir)
+    scope = _scope(topdir, cwd)
+    prefix = b('')
+    if scope is not None:
+        prefix = _fsencode(scope)[len(topdir) + 1:] + b('/')
+
+    # Each entry reads '<mode> <type> <object>\t<file>'
+    tab, gitlink = b('\t'), b('160000')
+    paths = [entry.partition(tab)[2]
+             for entry in _splitpaths(_gittree(topdir, gitdir, commit, scope))
+             if entry[:6] != gitlink]
+    if _exportignore():
+        ignored = _exportignored(topdir, gitdir, paths, commit)
+        paths = [path for path in paths if path not in ignored]
+    with trace.phase('decode', paths=len(paths)):
+        res = _decode(b(''), [path[len(prefix):] for path in paths])
+    if os.sep != '/':
+        res = [name.replace('/', os.sep) for name in res]
+    return res
+
+
+def stage(revision=None, dirname='', directory=None):
+    # Write the files of revision (SETUPTOOLS_GIT_REVISION or HEAD by
+    # default) in the repository containing dirname to directory, a
+    # new temporary directory unless given, and return that directory.
+    # The whole tree is written, so that projects below the toplevel
+    # are built in the same place relative to it, with GIT_WORK_TREE
+    # pointing at directory. Files come from 'git archive', so the
+    # work tree is not looked at, export-ignore and export-subst apply
+    # as in release tarballs, and several revisions can be staged at
+    # once. Unlike the file finder, this raises CalledProcessError or
+    # OSError when it fails.
+    import tarfile
+    import tempfile
+    revision = revision or _revision() or 'HEAD'
+    topdir, gitdir = _gitrepo(dirname)
+    if directory is None:
+        directory = tempfile.mkdtemp(prefix='setuptools-git-')
+
+    args = ['git', 'archive', '--format=tar', revision]
+    with trace.phase('archive', revision=revision) as phase:
+        devnull = open(os.devnull, 'wb')
+        try:
+            # Run at the toplevel, as Git archives only the directory
+            # it runs in
+            process = Popen(args, cwd=_lsfilesargs(topdir, [])[0],
+                            stdout=PIPE, stderr=devnull,
+                            env=_gitenv(gitdir))
+        finally:
+            devnull.close()
+        try:
+            archive = tarfile.open(fileobj=process.stdout, mode='r|')
+            try:
+                if hasattr(tarfile, 'tar_filter'):
+                    archive.extractall(directory, filter='tar')
+                else:
+                    archive.extractall(directory)
+                phase.update(entries=len(archive.getmembers()))
+            finally:
+                archive.close()
+        except tarfile.TarError:
+            process.stdout.close()
+            if process.wait():
+                raise CalledProcessError(process.returncode, args)
+            raise
+        process.stdout.close()
+        if process.wait():
+            raise CalledProcessError(process.returncode, args)
+    return directory
+
+
+def _scope(topdir, cwd):
+    # The directory to limit 'git ls-files' to for listing the real
+    # directory cwd, None at the toplevel
+    if posix(cwd) + '/' == _topprefix(topdir):
+        return None
+    return cwd
 
-    git_dirs = _gitlsdirs(git_files, prefix_length)
 
-    if sys.version_info >= (2, 6):
-        walker = os.walk(cwd, followlinks=True)
+def _wholetree(topdir, gitdir, method):
+    # What _listfiles needs of the whole work tree to list any
+    # directory in it with the given method
+    if method == 'tree':
+        return None
+    if method == 'index':
+        modes = _load(topdir, gitdir, _gitmodes)
+        return modes, sorted(modes[0])
+    return _load(topdir, gitdir, _gitfiles)
+
+
+def _listfiles(topdir, gitdir, dirname, method, whole=None):
+    # List the files below dirname first, and only list the whole work
+    # tree when a symbolic link leads out of dirname. Callers that have
+    # the result of _wholetree already pass it as whole.
+    cwd = realpath(dirname or os.curdir)
+    prefix = posix(cwd) + '/'
+    if whole is not None:
+        scope = None
     else:
-        walker = os.walk(cwd)
+        scope = _scope(topdir, cwd)
 
-    for root, dirs, files in walker:
-        dirs[:] = [x for x in dirs if posix(realpath(join(root, x))) in git_dirs]
-        for file in files:
-            filename = join(root, file)
-            if posix(realpath(filename)) in git_files:
-                yield filename[prefix_length:]
+    if method == 'index':
+        if whole is not None:
+            modes, ordered = whole
+        else:
+            modes, ordered = _load(topdir, gitdir, _gitmodes, scope), None
+        if not modes[0]:
+            return []
+        def widen():
+            return _load(topdir, gitdir, _gitmodes)
 
+        return _listfiles_index(dirname, modes, scope and widen, ordered)
 
-if __name__ == '__main__':
-    if len(sys.argv) > 1:
-        dirname = sys.argv[1]
+    if whole is not None:
+        files = whole
     else:
-        dirname = ''
-    for filename in listfiles(dirname):
+        files = _load(topdir, gitdir, _gitfiles, scope)
+    if not files:
+        return []
+    git_files = _Widening(prefix, files)
+    git_dirs = _Widening(prefix, files.dirs)
+    if scope is not None:
+        def widen_files():
+            return _load(topdir, gitdir, _gitfiles)
+
+        def widen_dirs():
+            return widen_files().dirs
+
+        git_files.widen = widen_files
+        git_dirs.widen = widen_dirs
+
+    table = _loadtable(gitdir, cwd)
+    res = list(_listfiles_walk(dirname, git_files, git_dirs, table))
+    if table is not None:
+        _savetable(gitdir, cwd, table)
+    return res
+
+
+def _method(method=None):
+    # The method listfiles uses unless told otherwise, 'tree' to
+    # package SETUPTOOLS_GIT_REVISION if set
+    if method:
+        return method
+    if _revision() is not None:
+        return os.environ.get('SETUPTOOLS_GIT_LISTFILES', 'tree')
+    return os.environ.get('SETUPTOOLS_GIT_LISTFILES', 'walk')
+
+
+def listfiles(dirname='', method=None):
+    # The 'walk' method (the default) visits the work tree and returns
+    # what is actually there; the 'index' method trusts the index and
+    # only looks at the file system to resolve symbolic links; the
+    # 'tree' method lists the files of SETUPTOOLS_GIT_REVISION, or
+    # HEAD, without looking at either.
+    #
+    # Results are cached until HEAD or the index change, on the
+    # assumption that the work tree does not change under a build.
+    method = _method(method)
+
+    try:
+        topdir, gitdir = _gitrepo(dirname)
+        res = _listed(topdir, gitdir, dirname, method)
+    except (CalledProcessError, OSError):
+        # Setuptools mandates we fail silently
+        return
+
+    for filename in res:
+        yield filename
+
+
+def _listed(topdir, gitdir, dirname, method, whole=None):
+    # The result of _listfiles, cached
+    slot = (topdir, 'listfiles', method, realpath(dirname or os.curdir),
+            _submodules(), _exportignore())
+    if method == 'tree':
+        commit = _commit(dirname or None, gitdir, _revision() or 'HEAD')
+        slot += (commit,)
+
+    def compute():
+        with trace.phase('listfiles', method=method) as phase:
+            if method == 'tree':
+                res = _listfiles_tree(topdir, gitdir, dirname, commit)
+            else:
+                res = _listfiles(topdir, gitdir, dirname, method, whole)
+            phase.update(paths=len(res))
+        return res
+
+    if method != 'tree' and _submodules():
+        # The cache is keyed on the superproject alone, which commits in
+        # a submodule leave as it is; the listing of each submodule is
+        # cached under its own key instead
+        return compute()
+    return memo(gitdir, slot, compute)
+
+
+def listfiles_many(dirnames, method=None):
+    # Return a dict from each of dirnames to a list of what
+    # listfiles(dirname, method) yields, for projects that share a
+    # repository. Each work tree is listed by Git once, as a whole,
+    # and the lists of the directories in it are taken from that.
+    method = _method(method)
+
+    res = {}
+    wholetrees = {}
+    for dirname in dirnames:
         try:
-            print(compose(filename))
-        except UnicodeEncodeError:
-            print(repr(filename)[1:-1])
+            topdir, gitdir = _gitrepo(dirname)
+            if gitdir not in wholetrees:
+                wholetrees[gitdir] = _wholetree(topdir, gitdir, method)
+            res[dirname] = list(_listed(topdir, gitdir, dirname, method,
+                                        wholetrees[gitdir]))
+        except (CalledProcessError, OSError):
+            # Setuptools mandates we fail silently
+            res[dirname] = []
+    return res
 
@@ -0,0 +1,112 @@
+"""
+List the files setuptools-git finds, for use in build scripts:
+
+  $> python -m setuptools_git [-z | --json] [--stats] [DIRECTORY]
+  $> python -m setuptools_git --version
+
+Names go out one per line, NUL terminated with -z, or as JSON objects
+one per line with --json. They are written in bulk to the binary
+standard output, so listing many files is bound by I/O rather than by
+formatting.
+"""
+import sys
+import os
+import json
+import time
+import argparse
+
+import setuptools_git
+from setuptools_git.cache import memo
+from setuptools_git.utils import b
+from setuptools_git.utils import compose
+from setuptools_git.utils import CalledProcessError
+
+__all__ = ['main']
+
+# Names written at once
+_CHUNK = 8192
+
+
+def _encode(name):
+    # The bytes the file system uses for a name
+    if isinstance(name, bytes):
+        return name  # Python 2
+    if sys.version_info >= (3,):
+        return os.fsencode(name)
+    return name.encode(sys.getfilesystemencoding())
+
+
+def _lines(names, style):
+    # Return the output for names as bytes
+    if style == 'json':
+        return b('').join([
+            b(json.dumps({'path': name}), 'ascii') + b('\n')
+            for name in names])
+    if style == 'nul':
+        end = b('\x00')
+    else:
+        end = b('\n')
+    return b('').join([_encode(name) + end for name in names])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m setuptools_git',
+        description='List the files in a Git work tree that setuptools '
+                    'would include in a distribution.')
+    parser.add_argument('directory', nargs='?', default='')
+    parser.add_argument('-z', dest='style', action='store_const',
+                        const='nul', help='terminate names with NUL')
+    parser.add_argument('--json', dest='style', action='store_const',
+                        const='json', help='write a JSON object per name')
+    parser.add_argument('--method', choices=['walk', 'index', 'tree'],
+                        help='how to find the files, see README')
+    parser.add_argument('--revision',
+                        help='list the files of, or describe, this commit '
+                             'or tag instead of the work tree')
+    parser.add_argument('--version', action='store_true',
+                        help='print the version use_vcs_version would '
+                             'calculate instead')
+    parser.add_argument('--stats', action='store_true',
+                        help='report timings on standard error')
+    args = parser.parse_args(argv)
+    if args.revision:
+        os.environ['SETUPTOOLS_GIT_REVISION'] = args.revision
+
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    start = time.time()
+    count = 0
+    if args.version:
+        # Unlike the file finder, this fails outside a work tree or
+        # without tags, Git having said why on standard error
+        try:
+            if args.directory:
+                os.chdir(args.directory)
+            version = setuptools_git.calculate_version()
+        except (CalledProcessError, OSError):
+            sys.stderr.write('%s: cannot calculate the version: %s\n'
+                             % (parser.prog, sys.exc_info()[1]))
+            return 1
+        out.write(version + b('\n'))
+    else:
+        names = [compose(name) for name in
+                 setuptools_git.listfiles(args.directory, args.method)]
+        for i in range(0, len(names), _CHUNK):
+            out.write(_lines(names[i:i + _CHUNK], args.style))
+        count = len(names)
+    out.flush()
+
+    if args.stats:
+        stats = {
+            'seconds': time.time() - start,
+            'files': count,
+            'memo': memo.info(),
+        }
+        if args.version:
+            stats['version_seconds'] = setuptools_git.versionstats['seconds']
+        sys.stderr.write(json.dumps(stats, sort_keys=True) + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
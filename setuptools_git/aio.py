@@ -0,0 +1,204 @@
+"""
+Coroutines for asyncio code that lists the files of, or calculates the
+versions of, many packages at once. Python 3.7 or later only:
+
+  lists = await asyncio.gather(*[async_listfiles(package)
+                                 for package in packages])
+
+Git runs through asyncio.create_subprocess_exec and its output is read
+as it comes. The rest of the work, like decoding paths and walking the
+work tree, runs in the default executor. Results go into the same
+caches as those of the synchronous functions, and calls waiting for
+the same listing share one Git process. At most SETUPTOOLS_GIT_JOBS
+(8 by default) calls run at once per event loop.
+"""
+import os
+import time
+import asyncio
+import weakref
+import functools
+
+from os.path import realpath
+from subprocess import DEVNULL
+from subprocess import PIPE
+
+import setuptools_git
+from setuptools_git import trace
+from setuptools_git import _gitrepo
+from setuptools_git import _gitfiles
+from setuptools_git import _gitmodes
+from setuptools_git import _filetable
+from setuptools_git import _modetable
+from setuptools_git import _gitlsfiles
+from setuptools_git import _lsfilesargs
+from setuptools_git import _slot
+from setuptools_git import _scope
+from setuptools_git import _submodules
+from setuptools_git import _describe
+from setuptools_git import _describeargs
+from setuptools_git import _dirty
+from setuptools_git import _gitenv
+from setuptools_git import _tagargs
+from setuptools_git import _jobs
+from setuptools_git import _method
+from setuptools_git import _revision
+from setuptools_git.cache import memo
+from setuptools_git.cache import disk
+from setuptools_git.cache import state
+from setuptools_git.cache import tagstate
+from setuptools_git.utils import CalledProcessError
+
+__all__ = ['async_gitlsfiles', 'async_listfiles', 'async_calculate_version']
+
+# Per event loop, the semaphore limiting calls and the computations
+# under way by memo slot
+_limits = weakref.WeakKeyDictionary()
+_pending = weakref.WeakKeyDictionary()
+
+_parsers = {
+    _gitfiles: (_filetable, []),
+    _gitmodes: (_modetable, ['--stage']),
+}
+
+
+def _limit():
+    loop = asyncio.get_running_loop()
+    semaphore = _limits.get(loop)
+    if semaphore is None:
+        semaphore = _limits[loop] = asyncio.Semaphore(_jobs())
+    return semaphore
+
+
+async def _thread(function, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        None, functools.partial(function, *args))
+
+
+async def _git(name, args, cwd=None, env=None, bufsize=65536):
+    # Run 'git name args' and return its output
+    with trace.phase(name, args=args) as phase:
+        process = await asyncio.create_subprocess_exec(
+            'git', name, *args, cwd=cwd, env=env, stdout=PIPE,
+            stderr=DEVNULL)
+        chunks = []
+        while True:
+            chunk = await process.stdout.read(bufsize)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        if await process.wait():
+            raise CalledProcessError(process.returncode, ['git', name] + args)
+        res = b''.join(chunks)
+        phase.update(bytes=len(res))
+    return res
+
+
+async def _memo(gitdir, slot, compute):
+    # Like memo(gitdir, slot, compute), for a coroutine function
+    if not memo.enabled():
+        return await compute()
+
+    key = state(gitdir)
+    found, value = memo.lookup(gitdir, slot, key)
+    if found:
+        return value
+
+    pending = _pending.setdefault(asyncio.get_running_loop(), {})
+    name = (gitdir, slot, key)
+    task = pending.get(name)
+    if task is None:
+        task = pending[name] = asyncio.ensure_future(compute())
+        task.add_done_callback(lambda task: pending.pop(name, None))
+    # One caller giving up must not cancel the others
+    value = await asyncio.shield(task)
+    memo.store(gitdir, slot, key, value)
+    return value
+
+
+async def _lsfiles(topdir, gitdir, args, scope=None):
+    if (disk.enabled() or
+            os.environ.get('SETUPTOOLS_GIT_BACKEND') == 'python'):
+        # Usually answered without running Git at all
+        return await _thread(_gitlsfiles, topdir, gitdir, args, scope)
+    cwd, args = _lsfilesargs(topdir, args, scope)
+    return await _git('ls-files', ['-z'] + args, cwd, _gitenv(gitdir))
+
+
+async def _load(topdir, gitdir, query, scope=None):
+    # Like setuptools_git._load without submodules
+    parse, args = _parsers[query]
+
+    async def compute():
+        tagged_args, tagged = _tagargs(gitdir, args)
+        blob = await _lsfiles(topdir, gitdir, tagged_args, scope)
+        return await _thread(parse, topdir, gitdir, blob, tagged)
+
+    return await _memo(gitdir, _slot(topdir, query, scope), compute)
+
+
+async def async_gitlsfiles(dirname=''):
+    # The same as setuptools_git.gitlsfiles
+    async with _limit():
+        if _submodules():
+            return await _thread(setuptools_git.gitlsfiles, dirname)
+        try:
+            topdir, gitdir = await _thread(_gitrepo, dirname)
+            res = await _load(topdir, gitdir, _gitfiles)
+        except (CalledProcessError, OSError):
+            # Setuptools mandates we fail silently
+            return set()
+    return set(res)
+
+
+async def async_listfiles(dirname='', method=None):
+    # A list of what setuptools_git.listfiles yields
+    method = _method(method)
+
+    def listfiles():
+        return list(setuptools_git.listfiles(dirname, method))
+
+    async with _limit():
+        if not _submodules() and method != 'tree':
+            # Have Git list the files here, so that listfiles finds
+            # them in the memo and only walks the work tree
+            try:
+                topdir, gitdir = await _thread(_gitrepo, dirname)
+                scope = _scope(topdir, realpath(dirname or os.curdir))
+                if method == 'index':
+                    await _load(topdir, gitdir, _gitmodes, scope)
+                else:
+                    await _load(topdir, gitdir, _gitfiles, scope)
+            except (CalledProcessError, OSError):
+                # Setuptools mandates we fail silently
+                return []
+        return await _thread(listfiles)
+
+
+async def async_calculate_version(dirname=''):
+    # Like setuptools_git.calculate_version, for the work tree
+    # containing dirname instead of the current directory
+    dirty = _dirty()
+    start = time.time()
+    try:
+        async with _limit():
+            if disk.enabled() or _revision() is not None:
+                return await _thread(_describe, dirty, dirname)
+
+            args = _describeargs(dirty)[2:]
+            cwd = dirname or None
+            try:
+                topdir, gitdir = await _thread(_gitrepo, dirname)
+            except OSError:
+                # Not a repository, let Git say so
+                return (await _git('describe', args, cwd)).strip()
+
+            async def compute():
+                return (await _git('describe', args, cwd,
+                                   _gitenv(gitdir))).strip()
+
+            return await _memo(
+                gitdir, ('describe', dirty, tagstate(gitdir)), compute)
+    finally:
+        setuptools_git.versionstats['calls'] += 1
+        setuptools_git.versionstats['seconds'] += time.time() - start
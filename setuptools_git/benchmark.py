@@ -0,0 +1,356 @@
+"""
+Benchmarks for the file finder and the version hook.
+
+Builds a synthetic repository of the requested shape in a temporary
+directory, times the public entry points against it and writes the
+results as JSON, optionally comparing them with an earlier run:
+
+  $> python -m setuptools_git.benchmark --files 100000 -o after.json \
+         --compare before.json
+
+Everything runs offline against local repositories. With --micro
+the internal algorithms are timed on a synthetic listing instead,
+without creating a repository.
+"""
+import sys
+import os
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+
+from os.path import join
+
+import setuptools_git
+from setuptools_git.cache import memo
+from setuptools_git.utils import rmtree
+from setuptools_git.utils import check_call
+from setuptools_git.utils import check_output
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None  # Python < 3.4
+
+__all__ = ['Shape', 'make_repo', 'run', 'micro', 'importtime', 'compare',
+           'main']
+
+
+class Shape(object):
+    """
+    The shape of a synthetic repository.
+    """
+
+    def __init__(self, files=1000, depth=3, width=10, nonascii=0.0,
+                 symlinks=0, untracked=0, submodules=0):
+        self.files = files
+        self.depth = depth
+        self.width = width
+        self.nonascii = nonascii
+        self.symlinks = symlinks
+        self.untracked = untracked
+        self.submodules = submodules
+
+    def asdict(self):
+        return dict(self.__dict__)
+
+    def directories(self):
+        # Spread files over a tree width directories wide and depth deep
+        res = ['']
+        level = ['']
+        for i in range(self.depth):
+            level = [join(parent, 'dir%d' % n)
+                     for parent in level for n in range(self.width)]
+            res.extend(level)
+            if len(res) > self.files:
+                break
+        return res
+
+    def filenames(self):
+        directories = self.directories()
+        every = int(1 / self.nonascii) if self.nonascii else 0
+        for i in range(self.files):
+            if every and i % every == 0:
+                name = u'h\xe9h\xe9-%d.txt' % i
+            else:
+                name = 'file-%d.txt' % i
+            yield join(directories[i % len(directories)], name)
+
+
+def _git(*args, **kw):
+    check_call(['git', '-c', 'user.name=benchmark',
+                '-c', 'user.email=benchmark@example.com',
+                '-c', 'protocol.file.allow=always'] + list(args), **kw)
+
+
+def _touch(filename):
+    directory = os.path.dirname(filename)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd = open(filename, 'wb')
+    fd.close()
+
+
+def _populate(directory, shape):
+    _git('init', '--quiet', directory)
+    for filename in shape.filenames():
+        _touch(join(directory, filename))
+    for i in range(shape.symlinks):
+        os.symlink('dir%d' % (i % shape.width), join(directory, 'link%d' % i))
+    _git('add', '--all', cwd=directory)
+    _git('commit', '--quiet', '--allow-empty', '-m', 'benchmark', cwd=directory)
+    _git('tag', 'v1.0', cwd=directory)
+    for i in range(shape.untracked):
+        _touch(join(directory, 'build', 'clutter%d' % (i // 1000),
+                    'object%d.o' % i))
+
+
+def make_repo(shape, directory=None):
+    # Create a repository of the given shape and return its path
+    if directory is None:
+        directory = os.path.realpath(tempfile.mkdtemp())
+    top = join(directory, 'repo')
+    _populate(top, shape)
+    for i in range(shape.submodules):
+        module = join(directory, 'module%d' % i)
+        _populate(module, Shape(files=max(shape.files // 10, 1),
+                                depth=shape.depth, width=shape.width))
+        _git('submodule', '--quiet', 'add', module, 'sub%d' % i, cwd=top)
+    if shape.submodules:
+        _git('commit', '--quiet', '-m', 'add submodules', cwd=top)
+    return top
+
+
+class _Counter(object):
+    # Count the processes started while active
+
+    def __init__(self):
+        self.count = 0
+
+    def __enter__(self):
+        counter = self
+        self.saved = saved = subprocess.Popen
+
+        class Popen(saved):
+            def __init__(self, *args, **kw):
+                counter.count += 1
+                saved.__init__(self, *args, **kw)
+
+        subprocess.Popen = setuptools_git.Popen = Popen
+        return self
+
+    def __exit__(self, *exc_info):
+        subprocess.Popen = setuptools_git.Popen = self.saved
+
+
+def entrypoints(top):
+    # The public entry points, by name
+    def listfiles(method):
+        return lambda: list(setuptools_git.listfiles(top, method=method))
+
+    def calculate_version():
+        cwd = os.getcwd()
+        os.chdir(top)
+        try:
+            return setuptools_git.calculate_version()
+        finally:
+            os.chdir(cwd)
+
+    return [
+        ('gitlsfiles', lambda: setuptools_git.gitlsfiles(top)),
+        ('gitlsdirs', lambda: setuptools_git.gitlsdirs(top)),
+        ('itergitlsfiles',
+         lambda: list(setuptools_git.itergitlsfiles(top))),
+        ('listfiles[walk]', listfiles('walk')),
+        ('listfiles[index]', listfiles('index')),
+        ('listfiles[tree]', listfiles('tree')),
+        ('calculate_version', calculate_version),
+    ]
+
+
+def measure(function, repeat=3):
+    # Best wall time of repeat cold runs, processes started, and peak
+    # memory of one more run along with what the caches keep after it
+    res = {}
+    best = None
+    for i in range(repeat):
+        memo.clear()
+        with _Counter() as counter:
+            start = time.time()
+            function()
+            elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    res['seconds'] = best
+    res['subprocesses'] = counter.count
+
+    if tracemalloc is not None:
+        memo.clear()
+        tracemalloc.start()
+        try:
+            function()
+            res['retained_bytes'], res['peak_bytes'] = \
+                tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    return res
+
+
+def importtime(repeat=3):
+    # Best time to import the package in a new interpreter, as
+    # reported by -X importtime, or None before Python 3.7
+    if sys.version_info < (3, 7):
+        return None
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.path.dirname(
+        os.path.dirname(os.path.abspath(setuptools_git.__file__)))
+    best = None
+    for i in range(repeat):
+        process = subprocess.Popen(
+            [sys.executable, '-X', 'importtime', '-c',
+             'import setuptools_git'], stderr=subprocess.PIPE, env=env)
+        output = process.communicate()[1].decode('utf-8', 'replace')
+        for line in output.splitlines():
+            fields = [field.strip() for field in line.split('|')]
+            if len(fields) == 3 and fields[2] == 'setuptools_git':
+                seconds = int(fields[1]) / 1e6
+                if best is None or seconds < best:
+                    best = seconds
+    return best
+
+
+def run(shape, repeat=3, names=None):
+    # Benchmark every entry point on a repository of the given shape
+    directory = os.path.realpath(tempfile.mkdtemp())
+    saved = os.environ.get('SETUPTOOLS_GIT_DISK_CACHE')
+    os.environ['SETUPTOOLS_GIT_DISK_CACHE'] = '0'
+    try:
+        start = time.time()
+        top = make_repo(shape, directory)
+        setup = time.time() - start
+        if shape.submodules:
+            os.environ['SETUPTOOLS_GIT_SUBMODULES'] = '1'
+        results = {}
+        for name, function in entrypoints(top):
+            if names and name not in names:
+                continue
+            results[name] = measure(function, repeat)
+        if not names or 'import' in names:
+            seconds = importtime(repeat)
+            if seconds is not None:
+                results['import'] = {'seconds': seconds}
+    finally:
+        os.environ.pop('SETUPTOOLS_GIT_SUBMODULES', None)
+        if saved is None:
+            del os.environ['SETUPTOOLS_GIT_DISK_CACHE']
+        else:
+            os.environ['SETUPTOOLS_GIT_DISK_CACHE'] = saved
+        rmtree(directory)
+
+    return {
+        'shape': shape.asdict(),
+        'setup_seconds': setup,
+        'python': platform.python_version(),
+        'platform': sys.platform,
+        'git': check_output(['git', '--version']).decode('ascii').strip(),
+        'results': results,
+    }
+
+
+def micro(shape, repeat=3):
+    # Time the algorithms working on lists of paths against a listing
+    # of the given shape
+    top = '/home/builder/workspace/project/checkout/'
+    paths = sorted(top + path.replace(os.sep, '/')
+                   for path in shape.filenames())
+
+    def ancestors():
+        dirs = set()
+        for path in paths:
+            setuptools_git._ancestors(dirs, path.rpartition('/')[0],
+                                      len(top))
+        return dirs
+
+    functions = [
+        ('_ancestors', ancestors),
+        ('_PathTable', lambda: setuptools_git._PathTable(paths, len(top))),
+    ]
+    results = {}
+    for name, function in functions:
+        results[name] = measure(function, repeat)
+    return {
+        'shape': shape.asdict(),
+        'python': platform.python_version(),
+        'platform': sys.platform,
+        'results': results,
+    }
+
+
+def compare(old, new):
+    # Return lines comparing the results of two runs
+    lines = ['%-20s %12s %12s %8s' % ('entry point', 'before', 'after',
+                                      'ratio')]
+    for name in sorted(new['results']):
+        after = new['results'][name]['seconds']
+        before = old['results'].get(name, {}).get('seconds')
+        if before is None:
+            lines.append('%-20s %12s %11.4fs %8s' % (name, '-', after, '-'))
+        else:
+            lines.append('%-20s %11.4fs %11.4fs %7.2fx' % (
+                name, before, after, before / max(after, 1e-9)))
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m setuptools_git.benchmark',
+        description='Benchmark setuptools-git on a synthetic repository.')
+    parser.add_argument('--files', type=int, default=10000)
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--width', type=int, default=10)
+    parser.add_argument('--nonascii', type=float, default=0.0,
+                        help='fraction of file names that are not ASCII')
+    parser.add_argument('--symlinks', type=int, default=0)
+    parser.add_argument('--untracked', type=int, default=0)
+    parser.add_argument('--submodules', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', action='append', metavar='ENTRYPOINT',
+                        help='only benchmark this entry point')
+    parser.add_argument('--micro', action='store_true',
+                        help='time the internal algorithms on a listing '
+                             'instead of the entry points on a repository')
+    parser.add_argument('-o', '--output', help='write results to this file')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare with the results of an earlier run')
+    args = parser.parse_args(argv)
+
+    shape = Shape(files=args.files, depth=args.depth, width=args.width,
+                  nonascii=args.nonascii, symlinks=args.symlinks,
+                  untracked=args.untracked, submodules=args.submodules)
+    if args.micro:
+        res = micro(shape, args.repeat)
+    else:
+        res = run(shape, args.repeat, args.only)
+
+    output = json.dumps(res, indent=2, sort_keys=True)
+    if args.output:
+        fd = open(args.output, 'w')
+        fd.write(output + '\n')
+        fd.close()
+    else:
+        print(output)
+
+    if args.compare:
+        fd = open(args.compare)
+        try:
+            old = json.load(fd)
+        finally:
+            fd.close()
+        for line in compare(old, res):
+            sys.stderr.write(line + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,290 @@
+"""
+Caches for the results of Git queries.
+"""
+import os
+import time
+
+from os.path import join
+
+from setuptools_git.utils import b
+
+
+def readfile(filename):
+    try:
+        fd = open(filename, 'rb')
+    except (IOError, OSError):
+        return None
+    try:
+        return fd.read()
+    finally:
+        fd.close()
+
+
+def commondir(gitdir):
+    # Linked work trees keep their refs in the main Git directory
+    common = readfile(join(gitdir, 'commondir'))
+    if common is None:
+        return gitdir
+    return join(gitdir, common.strip().decode('utf-8'))
+
+
+def readref(gitdir, name):
+    # Resolve a ref like 'refs/heads/master' to an object id
+    for directory in (gitdir, commondir(gitdir)):
+        value = readfile(join(directory, name))
+        if value is not None:
+            value = value.strip()
+            if value.startswith(b('ref: ')):
+                return readref(gitdir, value[5:].decode('utf-8'))
+            return value
+    packed = readfile(join(commondir(gitdir), 'packed-refs'))
+    if packed:
+        name = b(name)
+        for line in packed.splitlines():
+            value, _, ref = line.partition(b(' '))
+            if ref == name:
+                return value
+    return None
+
+
+def readhead(gitdir):
+    return readref(gitdir, 'HEAD')
+
+
+def indexstat(gitdir):
+    # The index ends in a checksum of its contents, which, unlike its
+    # stat data, survives Git rewriting it just to refresh racy entries
+    filename = join(gitdir, 'index')
+    try:
+        st = os.stat(filename)
+        fd = open(filename, 'rb')
+    except (IOError, OSError):
+        return None
+    try:
+        if st.st_size > 20:
+            fd.seek(-20, 2)
+            checksum = fd.read(20)
+            if checksum.strip(b('\x00')):
+                return (st.st_size, checksum)
+    finally:
+        fd.close()
+    # Written with index.skipHash, Git replaces the index with a
+    # rename, so every write changes the inode
+    return (st.st_mtime, st.st_size, st.st_ino)
+
+
+def tagstate(gitdir):
+    # Stat data of everything that can define a tag
+    res = []
+    common = commondir(gitdir)
+    filenames = [join(common, 'packed-refs')]
+    for root, dirs, files in os.walk(join(common, 'refs', 'tags')):
+        filenames.extend(join(root, name) for name in files)
+    for filename in filenames:
+        try:
+            st = os.stat(filename)
+        except OSError:
+            continue
+        res.append((filename, st.st_mtime, st.st_size))
+    res.sort()
+    return tuple(res)
+
+
+def state(gitdir):
+    return (readhead(gitdir), indexstat(gitdir))
+
+
+class Memo(object):
+    """
+    Remember results per Git directory for as long as HEAD and the
+    index stay the same.
+
+    Set SETUPTOOLS_GIT_CACHE=0 in the environment to disable it.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def enabled(self):
+        return os.environ.get('SETUPTOOLS_GIT_CACHE', '1') != '0'
+
+    def __call__(self, gitdir, slot, compute):
+        if not self.enabled():
+            return compute()
+
+        # Take the key before computing, so that a change made
+        # meanwhile causes a miss next time instead of a stale hit
+        key = state(gitdir)
+        found, value = self.lookup(gitdir, slot, key)
+        if not found:
+            value = compute()
+            self.store(gitdir, slot, key, value)
+        return value
+
+    def lookup(self, gitdir, slot, key):
+        # Return whether a value for slot is remembered under key, and
+        # the value; entries under an older key are dropped
+        entry = self.entries.get(gitdir)
+        if entry is None or entry[0] != key:
+            if entry is not None:
+                self.evictions += len(entry[1])
+            entry = self.entries[gitdir] = (key, {})
+
+        values = entry[1]
+        if slot in values:
+            self.hits += 1
+            return True, values[slot]
+        self.misses += 1
+        return False, None
+
+    def store(self, gitdir, slot, key, value):
+        entry = self.entries.get(gitdir)
+        if entry is None:
+            entry = self.entries[gitdir] = (key, {})
+        elif entry[0] != key:
+            return  # Computed for a state already left behind
+        entry[1][slot] = value
+
+    def clear(self):
+        self.entries.clear()
+
+    def info(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': sum(len(values) for _, values in self.entries.values()),
+        }
+
+
+memo = Memo()
+
+
+class DiskCache(object):
+    """
+    Keep the output of Git queries in files below the Git directory,
+    so that later processes working on the same commit and index can
+    skip running Git.
+
+    Entries are written to a temporary file and renamed into place,
+    so readers only ever see complete entries. When the cache grows
+    past its size limit the least recently used entries are removed.
+
+    Set SETUPTOOLS_GIT_DISK_CACHE=1 in the environment to enable it,
+    and SETUPTOOLS_GIT_DISK_CACHE_SIZE to change the size limit.
+    """
+
+    dirname = 'setuptools-git'
+    maxsize = 64 * 1024 * 1024
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def enabled(self):
+        return os.environ.get('SETUPTOOLS_GIT_DISK_CACHE', '0') == '1'
+
+    def limit(self):
+        try:
+            return int(os.environ['SETUPTOOLS_GIT_DISK_CACHE_SIZE'])
+        except (KeyError, ValueError):
+            return self.maxsize
+
+    def path(self, gitdir, slot, key):
+        import hashlib
+        digest = hashlib.sha1(b(repr((slot, key)))).hexdigest()
+        return join(gitdir, self.dirname, digest)
+
+    def __call__(self, gitdir, slot, compute, key=state):
+        # Return the bytes compute() returns, from the cache if possible
+        if not self.enabled():
+            return compute()
+
+        filename = self.path(gitdir, slot, key(gitdir))
+        value = self.load(filename)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        self.misses += 1
+        value = compute()
+        # Another process may have changed the repository while Git ran,
+        # in which case the result may be that of either state
+        if self.path(gitdir, slot, key(gitdir)) == filename:
+            self.store(filename, value)
+        return value
+
+    def load(self, filename):
+        value = readfile(filename)
+        if value is not None:
+            try:
+                os.utime(filename, None)
+            except OSError:
+                pass  # Removed meanwhile, the value is still good
+        return value
+
+    def store(self, filename, value):
+        # Failing to cache must never fail the build
+        import tempfile
+        directory = os.path.dirname(filename)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            fd, tmpname = tempfile.mkstemp(prefix='.tmp', dir=directory)
+            try:
+                os.write(fd, value)
+            finally:
+                os.close(fd)
+            if hasattr(os, 'replace'):
+                os.replace(tmpname, filename)
+            else:
+                if os.path.exists(filename):
+                    os.remove(filename)
+                os.rename(tmpname, filename)
+        except (IOError, OSError):
+            return
+        self.prune(directory)
+
+    def prune(self, directory):
+        now = time.time()
+        entries = []
+        for name in os.listdir(directory):
+            filename = join(directory, name)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            if name.startswith('.tmp'):
+                # Left behind by a writer that died an hour ago
+                if st.st_mtime < now - 3600:
+                    self.remove(filename)
+                continue
+            entries.append((st.st_mtime, st.st_size, filename))
+
+        size = sum(entry[1] for entry in entries)
+        entries.sort()
+        while entries and size > self.limit():
+            _, entrysize, filename = entries.pop(0)
+            self.remove(filename)
+            self.evictions += 1
+            size -= entrysize
+
+    def remove(self, filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass  # Another process got there first
+
+    def info(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+disk = DiskCache()
@@ -0,0 +1,220 @@
+"""
+Long-running Git processes answering queries read from their standard
+input, for tools that embed setuptools-git and ask about the same
+repositories again and again.
+
+With SETUPTOOLS_GIT_HELPERS=1, such queries go to a process kept per
+work tree and command, so that each costs a round trip over pipes
+rather than starting Git. Git reads the index once when it starts, so
+a helper is replaced when the index changes. Helpers are stopped after
+SETUPTOOLS_GIT_HELPERS_IDLE seconds (60 by default) without queries,
+and when the process exits.
+"""
+import os
+import time
+import atexit
+import threading
+
+from subprocess import PIPE
+from subprocess import Popen
+
+from setuptools_git.utils import b
+from setuptools_git.cache import indexstat
+
+__all__ = ['query', 'shutdown', 'info', 'stats']
+
+# Helpers by work tree and command, the lock guarding them, the
+# condition the reaper waits on, and the process they were started in
+_helpers = {}
+_lock = threading.Lock()
+_wake = threading.Condition(_lock)
+_reaper = None
+_registered = False
+_pid = os.getpid()
+
+stats = {'started': 0, 'stopped': 0, 'queries': 0}
+
+# Queries up to this size are written without a thread, since a pipe
+# that Git has drained takes them without blocking
+_SMALL = 4096
+
+
+def _idle():
+    try:
+        return max(float(os.environ.get('SETUPTOOLS_GIT_HELPERS_IDLE', '60')),
+                   0.0)
+    except ValueError:
+        return 60.0
+
+
+class _Helper(object):
+    # A Git process reading NUL terminated queries and answering each
+    # with a fixed number of NUL terminated fields
+
+    def __init__(self, args, cwd, env, state):
+        # Have Git flush after every answer instead of when its buffer
+        # fills up, or both sides would wait for each other
+        env = dict(env or os.environ)
+        env['GIT_FLUSH'] = '1'
+        devnull = open(os.devnull, 'wb')
+        try:
+            self.process = Popen(args, cwd=cwd, env=env, stdin=PIPE,
+                                 stdout=PIPE, stderr=devnull)
+        finally:
+            devnull.close()
+        self.state = state
+        self.pid = os.getpid()
+        self.used = time.time()
+        self.lock = threading.Lock()
+
+    def _write(self, data):
+        try:
+            self.process.stdin.write(data)
+            self.process.stdin.flush()
+        except (IOError, OSError):
+            pass  # Git went away, which reading notices
+
+    def query(self, items, fields):
+        # Return the fields answering items
+        if self.process.stdin.closed:
+            raise IOError('helper stopped')
+        nul = b('\x00')
+        data = nul.join(items) + nul
+        if len(data) <= _SMALL:
+            writer = None
+            self._write(data)
+        else:
+            # Git answers while the rest is being written
+            writer = threading.Thread(target=self._write, args=(data,))
+            writer.daemon = True
+            writer.start()
+
+        fd = self.process.stdout.fileno()
+        expected = len(items) * fields
+        chunks = []
+        count = 0
+        try:
+            while count < expected:
+                chunk = os.read(fd, 65536)
+                if not chunk:
+                    raise IOError('git exited')
+                chunks.append(chunk)
+                count += chunk.count(nul)
+        finally:
+            if writer is not None:
+                writer.join()
+        res = b('').join(chunks).split(nul)
+        res.pop()
+        return res
+
+    def close(self):
+        # Git exits once its input ends
+        if self.process.stdin.closed:
+            return
+        for stream in (self.process.stdin, self.process.stdout):
+            try:
+                stream.close()
+            except (IOError, OSError):
+                pass
+        self.process.wait()
+        stats['stopped'] += 1
+
+
+def _reap():
+    # Stop the helpers that were idle for long enough, until none are
+    # left. Busy helpers are not touched.
+    global _reaper
+    while True:
+        reaped = []
+        with _lock:
+            now = time.time()
+            idle = _idle()
+            for key, helper in list(_helpers.items()):
+                if now - helper.used >= idle and helper.lock.acquire(False):
+                    del _helpers[key]
+                    reaped.append(helper)
+            if not reaped:
+                if not _helpers:
+                    _reaper = None
+                    return
+                wait = min(x.used for x in _helpers.values()) + idle - now
+                _wake.wait(max(wait, 0.05))
+                continue
+        # Waiting for Git to exit with the lock held would leave it held
+        # in a process forked meanwhile
+        for helper in reaped:
+            try:
+                helper.close()
+            finally:
+                helper.lock.release()
+
+
+def _get(key, args, cwd, env, state):
+    # The helper for key, started or replaced as needed
+    global _reaper, _registered, _pid
+    stale = None
+    with _lock:
+        if _pid != os.getpid():
+            # Forked: the pipes and the reaper belong to the parent
+            _helpers.clear()
+            _reaper = None
+            _pid = os.getpid()
+        helper = _helpers.get(key)
+        if helper is not None and helper.state != state:
+            stale = _helpers.pop(key)
+            helper = None
+        if helper is None:
+            helper = _helpers[key] = _Helper(args, cwd, env, state)
+            stats['started'] += 1
+            _wake.notify()
+            if not _registered:
+                atexit.register(shutdown)
+                _registered = True
+        helper.used = time.time()
+        if _reaper is None:
+            _reaper = threading.Thread(target=_reap)
+            _reaper.daemon = True
+            _reaper.start()
+    if stale is not None:
+        # Once a query under way, if any, is done with it
+        with stale.lock:
+            stale.close()
+    return helper
+
+
+def query(args, cwd, gitdir, items, fields, env=None):
+    # Answer items, a list of byte strings, with a long-running
+    # 'args' in cwd, fields per item. Raises IOError or OSError when
+    # the helper fails, after which the next query starts a new one.
+    key = (cwd, tuple(args))
+    helper = _get(key, args, cwd, env, indexstat(gitdir))
+    with helper.lock:
+        try:
+            res = helper.query(items, fields)
+        except (IOError, OSError):
+            with _lock:
+                if _helpers.get(key) is helper:
+                    del _helpers[key]
+            helper.close()
+            raise
+        helper.used = time.time()
+    stats['queries'] += 1
+    return res
+
+
+def shutdown():
+    # Stop all helpers
+    with _lock:
+        helpers = list(_helpers.values())
+        _helpers.clear()
+        _wake.notify()
+    for helper in helpers:
+        if helper.pid == os.getpid():
+            with helper.lock:
+                helper.close()
+
+
+def info():
+    res = dict(stats)
+    res['running'] = len(_helpers)
+    return res
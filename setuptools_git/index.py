@@ -0,0 +1,190 @@
+"""
+A reader for the Git index, to list files without running Git.
+
+See Documentation/gitformat-index.txt in the Git sources for the
+format. Versions 2, 3 and 4 are supported. Indexes that need an
+extension to be read correctly, like split or sparse indexes, are
+refused with UnsupportedIndex so callers can ask Git instead.
+"""
+import os
+import re
+import mmap
+import struct
+import binascii
+
+from os.path import join
+
+from setuptools_git.utils import b
+from setuptools_git.cache import readfile
+from setuptools_git.cache import commondir
+
+__all__ = ['UnsupportedIndex', 'readindex', 'lsfiles']
+
+
+class UnsupportedIndex(Exception):
+    """
+    Raised for an index this module cannot read faithfully.
+    """
+
+
+_header = struct.Struct('>4sII')
+_word = struct.Struct('>I')
+_half = struct.Struct('>H')
+
+# Entries start with ten words of stat data, the mode is the seventh
+_MODE = 24
+_OBJECT = 40
+
+_EXTENDED = 0x4000
+_STAGE = 0x3000
+_NAMEMASK = 0x0fff
+
+SKIP_WORKTREE = 0x4000
+
+
+def _hashsize(gitdir):
+    config = readfile(join(commondir(gitdir), 'config')) or b('')
+    if re.search(b(r'^\s*objectformat\s*=\s*sha256'), config,
+                 re.MULTILINE | re.IGNORECASE):
+        return 32
+    return 20
+
+
+def _byte(data, offset):
+    c = data[offset]
+    if isinstance(c, int):
+        return c
+    return ord(c)  # Python 2
+
+
+def _varint(data, offset):
+    # The offset encoding of Git's varint.c, used by index version 4
+    c = _byte(data, offset)
+    value = c & 127
+    while c & 128:
+        offset += 1
+        c = _byte(data, offset)
+        value = ((value + 1) << 7) | (c & 127)
+    return value, offset + 1
+
+
+def _entries(data, hashsize):
+    # Yield (mode, object id, stage, extended flags, path) per entry,
+    # checking the extensions that follow before the last one
+    if len(data) < _header.size + hashsize:
+        raise UnsupportedIndex('index file too short')
+    signature, version, count = _header.unpack_from(data, 0)
+    if signature != b('DIRC'):
+        raise UnsupportedIndex('not an index file')
+    if version not in (2, 3, 4):
+        raise UnsupportedIndex('index version %d' % version)
+
+    flagsoffset = _OBJECT + hashsize
+    offset = _header.size
+    previous = b('')
+    nul = b('\x00')
+    entries = []
+    for i in range(count):
+        mode = _word.unpack_from(data, offset + _MODE)[0]
+        flags = _half.unpack_from(data, offset + flagsoffset)[0]
+        start = offset + flagsoffset + 2
+        extended = 0
+        if flags & _EXTENDED:
+            if version < 3:
+                raise UnsupportedIndex('extended flags in version 2')
+            extended = _half.unpack_from(data, start)[0]
+            start += 2
+
+        if version == 4:
+            strip, start = _varint(data, start)
+            end = data.find(nul, start)
+            path = previous[:len(previous) - strip] + data[start:end]
+            previous = path
+            following = end + 1
+        else:
+            length = flags & _NAMEMASK
+            if length == _NAMEMASK:
+                end = data.find(nul, start + length)
+            else:
+                end = start + length
+            path = data[start:end]
+            # Entries are padded with NULs to a multiple of eight bytes
+            following = offset + ((end - offset + 8) & ~7)
+
+        if end < 0 or following > len(data) - hashsize:
+            raise UnsupportedIndex('truncated entry')
+        stage = (flags & _STAGE) >> 12
+        entries.append((mode, offset, stage, extended, path))
+        offset = following
+
+    # Extensions whose signature does not start with an upper case
+    # letter change the meaning of the entries and must be understood
+    end = len(data) - hashsize
+    while offset + 8 <= end:
+        signature = data[offset:offset + 4]
+        size = _word.unpack_from(data, offset + 4)[0]
+        if not b('A') <= signature[:1] <= b('Z'):
+            raise UnsupportedIndex(
+                'required extension %r' % signature.decode('latin-1'))
+        offset += 8 + size
+
+    for mode, entry, stage, extended, path in entries:
+        objectid = data[entry + _OBJECT:entry + _OBJECT + hashsize]
+        yield mode, objectid, stage, extended, path
+
+
+def readindex(filename, hashsize=20):
+    # Return the entries of the index as a list of tuples of mode,
+    # binary object id, stage, extended flags and path. The file is
+    # mapped into memory and only the parts returned are copied.
+    fd = open(filename, 'rb')
+    try:
+        if os.fstat(fd.fileno()).st_size == 0:
+            raise UnsupportedIndex('empty index file')
+        data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        fd.close()
+    try:
+        return list(_entries(data, hashsize))
+    except (struct.error, IndexError):
+        raise UnsupportedIndex('corrupt index file')
+    finally:
+        data.close()
+
+
+def lsfiles(gitdir, stage=False, prefix=None, tags=False):
+    # Return what 'git ls-files -z' would print at the toplevel, or
+    # with stage set what 'git ls-files -z --stage' would. With prefix,
+    # a path in Git's spelling, only the files below it are listed.
+    # With tags, entries start with the status tag of 'git ls-files -t'
+    # for the index: S for skip-worktree, M for unmerged, H otherwise.
+    if 'GIT_INDEX_FILE' in os.environ:
+        raise UnsupportedIndex('GIT_INDEX_FILE is set')
+    filename = join(gitdir, 'index')
+    if not os.path.exists(filename):
+        return b('')  # A fresh repository
+
+    if prefix is not None:
+        prefix = prefix.rstrip(b('/')) + b('/')
+    res = []
+    for mode, objectid, number, extended, path in readindex(
+            filename, _hashsize(gitdir)):
+        if prefix is not None and not path.startswith(prefix):
+            continue
+        if stage:
+            # Formatted as text, bytes have no % before Python 3.5
+            path = ('%06o %s %d\t' % (
+                mode, binascii.hexlify(objectid).decode('ascii'),
+                number)).encode('ascii') + path
+        if tags:
+            if extended & SKIP_WORKTREE:
+                path = b('S ') + path
+            elif number:
+                path = b('M ') + path
+            else:
+                path = b('H ') + path
+        res.append(path)
+    if not res:
+        return b('')
+    res.append(b(''))
+    return b('\x00').join(res)
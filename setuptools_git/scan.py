@@ -0,0 +1,111 @@
+"""
+Directory walks built on os.scandir.
+
+On most file systems the directory listing tells the type of each
+entry, so os.scandir sorts files, directories and symbolic links apart
+without a stat call per entry. Callers can also turn entries down by
+name before their type is looked at at all, which is how the file
+finder passes over untracked build output with a set lookup:
+
+  counters = scan.counters()
+  for root, dirs, files, links in scan.walk(top, counters, wanted):
+      ...
+
+Python versions without os.scandir fall back on os.listdir and stat
+calls.
+"""
+import os
+
+from os.path import join
+
+try:
+    from os import scandir
+except ImportError:
+    scandir = None  # Python < 3.5
+
+__all__ = ['counters', 'listdir', 'walk']
+
+
+def counters():
+    # Fresh counters for listdir and walk: the directories listed, the
+    # entries found in them, the entries turned down by name, and the
+    # stat calls made to tell types. Looking at every entry with
+    # lstat, as os.path.islink does, takes entries - stats more.
+    return {'directories': 0, 'entries': 0, 'skipped': 0, 'stats': 0}
+
+
+def listdir(path, counters=None, wanted=None):
+    # Return the names of the subdirectories, of the other entries and
+    # of the symbolic links in directory path, the first two without
+    # the links. wanted(name), if given, is asked about every entry
+    # that is not a symbolic link before its type is looked at, and
+    # those it turns down are left out. Unreadable directories are
+    # empty.
+    dirs, files, links = [], [], []
+    entries = skipped = stats = 0
+    try:
+        if scandir is not None:
+            iterator = scandir(path)
+            try:
+                for entry in iterator:
+                    entries += 1
+                    if entry.is_symlink():
+                        links.append(entry.name)
+                    elif wanted is not None and not wanted(entry.name):
+                        skipped += 1
+                    elif entry.is_dir():
+                        dirs.append(entry.name)
+                    else:
+                        files.append(entry.name)
+            finally:
+                if hasattr(iterator, 'close'):
+                    iterator.close()  # Python >= 3.6
+        else:
+            for name in os.listdir(path):
+                entries += 1
+                filename = join(path, name)
+                stats += 1
+                if os.path.islink(filename):
+                    links.append(name)
+                elif wanted is not None and not wanted(name):
+                    skipped += 1
+                else:
+                    stats += 1
+                    if os.path.isdir(filename):
+                        dirs.append(name)
+                    else:
+                        files.append(name)
+    except OSError:
+        pass
+    if counters is not None:
+        counters['directories'] += 1
+        counters['entries'] += entries
+        counters['skipped'] += skipped
+        counters['stats'] += stats
+    return dirs, files, links
+
+
+def walk(top, counters=None, wanted=None):
+    # Like os.walk(top, followlinks=True), but yield the set of the
+    # symbolic links in each directory as a fourth item. Links go with
+    # the directories or the other entries depending on their target,
+    # which takes a stat each. wanted(root, name), if given, turns
+    # entries down as in listdir. As with os.walk, removing names from
+    # the directories yielded keeps the walk out of them.
+    pending = [top]
+    while pending:
+        root = pending.pop()
+        if wanted is None:
+            dirs, files, links = listdir(root, counters)
+        else:
+            dirs, files, links = listdir(
+                root, counters, lambda name: wanted(root, name))
+        for name in links:
+            if os.path.isdir(join(root, name)):
+                dirs.append(name)
+            else:
+                files.append(name)
+        if counters is not None:
+            counters['stats'] += len(links)
+        yield root, dirs, files, set(links)
+        pending.extend(join(root, name) for name in reversed(dirs))
@@ -5,6 +5,7 @@ import tempfile
 import unittest
 
 from os.path import realpath, join
+from setuptools_git.utils import b
 from setuptools_git.utils import rmtree
 from setuptools_git.utils import posix
 from setuptools_git.utils import fsdecode
@@ -46,6 +47,13 @@ class GitTestCase(unittest.TestCase):
         check_call(['git', 'add', filename])
         check_call(['git', 'commit', '--quiet', '-m', 'add new file'])
 
+    def create_git_symlink(self, target, *path):
+        from setuptools_git.utils import check_call
+        filename = join(*path)
+        os.symlink(target, filename)
+        check_call(['git', 'add', filename])
+        check_call(['git', 'commit', '--quiet', '-m', 'add new symlink'])
+
 
 class gitlsfiles_tests(GitTestCase):
 
@@ -191,6 +199,102 @@ class gitlsfiles_tests(GitTestCase):
             setuptools_git.check_output = saved
 
 
+class gitlsdirs_tests(GitTestCase):
+
+    def test_nested(self):
+        from setuptools_git import gitlsdirs
+        self.create_git_file('root.txt')
+        self.create_dir('a', 'b', 'c')
+        self.create_git_file('a', 'b', 'c', 'deep.txt')
+        self.create_dir('a', 'd')
+        self.create_git_file('a', 'd', 'other.txt')
+        self.create_dir('untracked')
+        self.assertEqual(
+                gitlsdirs(),
+                set([posix(realpath(x)) for x in
+                     ('a', 'a/b', 'a/b/c', 'a/d')]))
+
+    def test_empty_repo(self):
+        from setuptools_git import gitlsdirs
+        self.assertEqual(gitlsdirs(self.directory), set())
+
+    def test_not_a_repo(self):
+        from setuptools_git import gitlsdirs
+        directory = realpath(tempfile.mkdtemp())
+        try:
+            os.environ['GIT_CEILING_DIRECTORIES'] = os.path.dirname(directory)
+            try:
+                self.assertEqual(gitlsdirs(directory), set())
+            finally:
+                del os.environ['GIT_CEILING_DIRECTORIES']
+        finally:
+            rmtree(directory)
+
+    def test_unsorted_files(self):
+        from setuptools_git import _PathTable
+        files = ['/top/a/b/1', '/top/c/2', '/top/a/b/3', '/top/a/4', '/top/5']
+        self.assertEqual(_PathTable(files, len('/top/')).dirs,
+                         set(['/top/a', '/top/a/b', '/top/c']))
+
+
+class itergitlsfiles_tests(gitlsfiles_tests):
+
+    def gitlsfiles(self, *a, **kw):
+        from setuptools_git import itergitlsfiles
+        return set(itergitlsfiles(*a, **kw))
+
+    def test_small_chunks(self):
+        self.create_git_file('root.txt')
+        self.create_dir('subdir')
+        self.create_git_file('subdir', 'entry.txt')
+        self.assertEqual(
+                self.gitlsfiles(self.directory, bufsize=3),
+                set([posix(realpath('root.txt')),
+                     posix(realpath('subdir/entry.txt'))]))
+
+    def test_git_error(self):
+        import setuptools_git
+
+        def do_raise(*args, **kw):
+            raise OSError('git')
+
+        self.create_git_file('root.txt')
+        saved = setuptools_git.Popen
+        setuptools_git.Popen = do_raise
+        try:
+            self.assertEqual(self.gitlsfiles(), set())
+        finally:
+            setuptools_git.Popen = saved
+
+    def test_memory_is_flat(self):
+        try:
+            import tracemalloc
+        except ImportError:
+            return  # Python < 3.4
+        from setuptools_git import gitlsfiles, itergitlsfiles
+        from setuptools_git.utils import check_call
+        self.create_dir('data')
+        for i in range(3000):
+            self.create_file('data', 'fixture-with-a-long-name-%05d.txt' % i)
+        check_call(['git', 'add', 'data'])
+        check_call(['git', 'commit', '--quiet', '-m', 'add fixtures'])
+
+        def peak(function, *args):
+            tracemalloc.start()
+            try:
+                for filename in function(*args):
+                    pass
+                return tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+        bufsize = 8192
+        streaming = peak(itergitlsfiles, self.directory, bufsize)
+        buffered = peak(gitlsfiles, self.directory)
+        self.assertTrue(streaming < 8 * bufsize, streaming)
+        self.assertTrue(buffered > 8 * bufsize, buffered)
+
+
 class listfiles_tests(GitTestCase):
 
     def listfiles(self, *a, **kw):
@@ -332,3 +436,1883 @@ class listfiles_tests(GitTestCase):
         finally:
             setuptools_git.check_output = saved
 
+
+    def test_subdir_is_listed_alone(self):
+        import setuptools_git
+        self.create_git_file('root.txt')
+        self.create_dir('subdir')
+        self.create_git_file('subdir', 'entry.txt')
+        calls = []
+
+        def record(args, **kw):
+            calls.append((args[1], kw.get('cwd')))
+            return saved(args, **kw)
+
+        saved = setuptools_git.check_output
+        setuptools_git.check_output = record
+        try:
+            self.assertEqual(
+                    set(self.listfiles(join(self.directory, 'subdir'))),
+                    set(['entry.txt']))
+        finally:
+            setuptools_git.check_output = saved
+        self.assertEqual(
+                [cwd for command, cwd in calls if command == 'ls-files'],
+                [join(self.directory, 'subdir')])
+
+    def test_deep_tree_lstat_per_entry(self):
+        from setuptools_git.utils import check_call
+        path = ['deep']
+        for i in range(10):
+            path.append('level%d' % i)
+            self.create_dir(*path)
+            for n in range(5):
+                self.create_file(*path + ['file%d.txt' % n])
+        check_call(['git', 'add', 'deep'])
+        check_call(['git', 'commit', '--quiet', '-m', 'add deep tree'])
+
+        calls = []
+        saved = os.lstat
+
+        def lstat(*args):
+            calls.append(args)
+            return saved(*args)
+
+        os.lstat = lstat
+        try:
+            self.assertEqual(len(list(self.listfiles())), 50)
+        finally:
+            os.lstat = saved
+        # About one per file and directory, where realpath takes one
+        # per path component, over 500 here
+        self.assertTrue(len(calls) < 100, len(calls))
+
+    if hasattr(os, 'symlink'):
+
+        def test_symlink_cycle(self):
+            self.create_dir('subdir')
+            self.create_git_file('subdir', 'entry.txt')
+            self.create_git_symlink('..', 'subdir', 'parent')
+            self.assertEqual(
+                    set(self.listfiles()),
+                    set([join('subdir', 'entry.txt')]))
+
+        def test_symlink_to_grandparent(self):
+            self.create_dir('pkg', 'sub')
+            self.create_git_file('pkg', 'a.py')
+            self.create_git_file('pkg', 'sub', 'b.py')
+            self.create_git_symlink('..', 'pkg', 'sub', 'up')
+            self.assertEqual(
+                    set(self.listfiles()),
+                    set([join('pkg', 'a.py'), join('pkg', 'sub', 'b.py')]))
+
+        def test_symlink_to_grandparent_from_subdir(self):
+            self.create_dir('pkg', 'sub')
+            self.create_git_file('pkg', 'a.py')
+            self.create_git_file('pkg', 'sub', 'b.py')
+            self.create_git_symlink('..', 'pkg', 'sub', 'up')
+            self.assertEqual(
+                    set(self.listfiles(join(self.directory, 'pkg', 'sub'))),
+                    set(['b.py']))
+
+        def test_symlink_mutual_cycle(self):
+            self.create_dir('a')
+            self.create_dir('b')
+            self.create_git_file('a', 'x')
+            self.create_git_file('b', 'y')
+            self.create_git_symlink(join('..', 'b'), 'a', 'tob')
+            self.create_git_symlink(join('..', 'a'), 'b', 'toa')
+            self.assertEqual(
+                    set(self.listfiles()),
+                    set([join('a', 'x'), join('b', 'y'),
+                         join('a', 'tob', 'y'), join('b', 'toa', 'x')]))
+
+        def test_symlink_to_symlinked_directory(self):
+            self.create_dir('data')
+            self.create_git_file('data', 'entry.txt')
+            self.create_git_symlink('data', 'first')
+            self.create_dir('subdir')
+            self.create_git_symlink(join('..', 'first'), 'subdir', 'second')
+            self.assertEqual(
+                    set(self.listfiles()),
+                    set([join('data', 'entry.txt'),
+                         join('first', 'entry.txt'),
+                         join('subdir', 'second', 'entry.txt')]))
+
+        def test_symlink_to_directory(self):
+            self.create_dir('subdir')
+            self.create_git_file('subdir', 'entry.txt')
+            self.create_git_symlink('subdir', 'link')
+            self.assertEqual(
+                    set(self.listfiles()),
+                    set([join('subdir', 'entry.txt'),
+                         join('link', 'entry.txt')]))
+
+        def test_symlink_to_file(self):
+            self.create_git_file('root.txt')
+            self.create_git_symlink('root.txt', 'link.txt')
+            self.assertEqual(
+                    set(self.listfiles()),
+                    set(['root.txt', 'link.txt']))
+
+        def test_symlink_out_of_subdir(self):
+            self.create_dir('data')
+            self.create_git_file('data', 'entry.txt')
+            self.create_dir('subdir')
+            self.create_git_file('subdir', 'root.txt')
+            self.create_git_symlink(join('..', 'data'), 'subdir', 'data')
+            self.assertEqual(
+                    set(self.listfiles(join(self.directory, 'subdir'))),
+                    set(['root.txt', join('data', 'entry.txt')]))
+
+        def test_symlink_to_untracked_file(self):
+            self.create_git_file('root.txt')
+            self.create_file('untracked.txt')
+            self.create_git_symlink('untracked.txt', 'link.txt')
+            self.assertEqual(
+                    set(self.listfiles()),
+                    set(['root.txt']))
+
+
+class listfiles_many_tests(GitTestCase):
+
+    def setUp(self):
+        from setuptools_git.cache import memo
+        GitTestCase.setUp(self)
+        memo.clear()
+        self.create_git_file('root.txt')
+        self.create_dir('shared')
+        self.create_git_file('shared', 'common.py')
+        for name in ('one', 'two'):
+            self.create_dir(name, 'pkg')
+            self.create_git_file(name, 'setup.py')
+            self.create_git_file(name, 'pkg', '__init__.py')
+        self.create_git_symlink(join(os.pardir, 'shared'), 'two', 'shared')
+        self.create_dir('one', 'build')
+        self.create_file('one', 'build', 'stray.py')
+
+    def test_same_as_listfiles(self):
+        from setuptools_git import listfiles, listfiles_many
+        from setuptools_git.cache import memo
+        dirnames = ['one', 'two', join('one', 'pkg'), '']
+        for method in ('walk', 'index'):
+            memo.clear()
+            res = listfiles_many(dirnames, method)
+            memo.clear()
+            for dirname in dirnames:
+                self.assertEqual(sorted(res[dirname]),
+                                 sorted(listfiles(dirname, method)))
+        self.assertTrue(join('shared', 'common.py') in res['two'])
+
+    def test_one_listing(self):
+        from setuptools_git import listfiles_many, trace
+        trace.enable(os.devnull)
+        try:
+            listfiles_many(['one', 'two', join('one', 'pkg')])
+            processes = [x for x in trace.events if x['phase'] == 'ls-files']
+        finally:
+            trace.disable()
+        self.assertEqual(len(processes), 1)
+        self.assertEqual(processes[0]['args'], [])
+
+    def test_not_a_repository(self):
+        from setuptools_git import listfiles_many
+        directory = realpath(tempfile.mkdtemp())
+        os.environ['GIT_CEILING_DIRECTORIES'] = os.path.dirname(directory)
+        try:
+            res = listfiles_many([directory, 'one'])
+        finally:
+            del os.environ['GIT_CEILING_DIRECTORIES']
+            rmtree(directory)
+        self.assertEqual(res[directory], [])
+        self.assertEqual(sorted(res['one']),
+                         [join('pkg', '__init__.py'), 'setup.py'])
+
+
+class listfiles_index_tests(listfiles_tests):
+
+    def listfiles(self, *a, **kw):
+        from setuptools_git import listfiles
+        kw.setdefault('method', 'index')
+        return listfiles(*a, **kw)
+
+    def test_environment(self):
+        from setuptools_git import listfiles
+        self.create_git_file('root.txt')
+        os.remove('root.txt')
+        os.environ['SETUPTOOLS_GIT_LISTFILES'] = 'index'
+        try:
+            self.assertEqual(set(listfiles()), set(['root.txt']))
+        finally:
+            del os.environ['SETUPTOOLS_GIT_LISTFILES']
+        self.assertEqual(set(listfiles()), set())
+
+
+class cache_tests(GitTestCase):
+
+    def setUp(self):
+        from setuptools_git.cache import memo
+        GitTestCase.setUp(self)
+        memo.clear()
+
+    def rev_parse(self, *args):
+        from setuptools_git.utils import check_output
+        return check_output(['git', 'rev-parse'] + list(args)).strip()
+
+    def test_repeated_calls_hit(self):
+        from setuptools_git import gitlsfiles
+        from setuptools_git.cache import memo
+        self.create_git_file('root.txt')
+        hits, misses = memo.hits, memo.misses
+        self.assertEqual(gitlsfiles(), set([posix(realpath('root.txt'))]))
+        self.assertEqual(gitlsfiles(), set([posix(realpath('root.txt'))]))
+        self.assertEqual(memo.misses, misses + 1)
+        self.assertEqual(memo.hits, hits + 1)
+
+    def test_index_change_evicts(self):
+        from setuptools_git import gitlsfiles
+        from setuptools_git.cache import memo
+        self.create_git_file('root.txt')
+        self.assertEqual(gitlsfiles(), set([posix(realpath('root.txt'))]))
+        evictions = memo.evictions
+        self.create_git_file('other.txt')
+        self.assertEqual(
+                gitlsfiles(),
+                set([posix(realpath('root.txt')),
+                     posix(realpath('other.txt'))]))
+        self.assertEqual(memo.evictions, evictions + 1)
+
+    def test_result_is_a_copy(self):
+        from setuptools_git import gitlsfiles
+        self.create_git_file('root.txt')
+        gitlsfiles().clear()
+        self.assertEqual(gitlsfiles(), set([posix(realpath('root.txt'))]))
+
+    def test_disabled(self):
+        from setuptools_git import gitlsfiles
+        from setuptools_git.cache import memo
+        self.create_git_file('root.txt')
+        os.environ['SETUPTOOLS_GIT_CACHE'] = '0'
+        try:
+            hits, misses = memo.hits, memo.misses
+            gitlsfiles()
+            gitlsfiles()
+            self.assertEqual((memo.hits, memo.misses), (hits, misses))
+        finally:
+            del os.environ['SETUPTOOLS_GIT_CACHE']
+
+    def test_readhead(self):
+        from setuptools_git.cache import readhead
+        self.create_git_file('root.txt')
+        self.assertEqual(readhead('.git'), self.rev_parse('HEAD'))
+
+    def test_readhead_packed(self):
+        from setuptools_git.cache import readhead
+        from setuptools_git.utils import check_call
+        self.create_git_file('root.txt')
+        check_call(['git', 'pack-refs', '--all', '--prune'])
+        self.assertEqual(readhead('.git'), self.rev_parse('HEAD'))
+
+    def test_readhead_worktree(self):
+        from setuptools_git.cache import readhead
+        from setuptools_git.utils import check_call
+        self.create_git_file('root.txt')
+        check_call(['git', 'worktree', 'add', '--quiet', '-b', 'other',
+                    join(self.directory, 'worktree')])
+        os.chdir(join(self.directory, 'worktree'))
+        self.create_git_file('other.txt')
+        gitdir = self.rev_parse('--git-dir').decode('utf-8')
+        self.assertEqual(readhead(gitdir), self.rev_parse('HEAD'))
+
+
+class disk_cache_tests(GitTestCase):
+
+    def setUp(self):
+        from setuptools_git.cache import memo
+        GitTestCase.setUp(self)
+        memo.clear()
+        os.environ['SETUPTOOLS_GIT_DISK_CACHE'] = '1'
+
+    def tearDown(self):
+        del os.environ['SETUPTOOLS_GIT_DISK_CACHE']
+        os.environ.pop('SETUPTOOLS_GIT_DISK_CACHE_SIZE', None)
+        GitTestCase.tearDown(self)
+
+    def entries(self):
+        directory = join(self.directory, '.git', 'setuptools-git')
+        if not os.path.isdir(directory):
+            return []
+        return os.listdir(directory)
+
+    def test_later_process_hits(self):
+        from setuptools_git import gitlsfiles
+        from setuptools_git.cache import disk, memo
+        self.create_git_file('root.txt')
+        gitlsfiles()
+        self.assertEqual(len(self.entries()), 1)
+        memo.clear()
+        hits = disk.hits
+        self.assertEqual(gitlsfiles(), set([posix(realpath('root.txt'))]))
+        self.assertEqual(disk.hits, hits + 1)
+
+    def test_index_change_misses(self):
+        from setuptools_git import gitlsfiles
+        from setuptools_git.cache import memo
+        self.create_git_file('root.txt')
+        gitlsfiles()
+        memo.clear()
+        self.create_git_file('other.txt')
+        self.assertEqual(
+                gitlsfiles(),
+                set([posix(realpath('root.txt')),
+                     posix(realpath('other.txt'))]))
+
+    def test_change_while_computing(self):
+        from setuptools_git import gitlsfiles
+        from setuptools_git.cache import disk, memo
+        from setuptools_git.utils import check_call, check_output
+        self.create_git_file('root.txt')
+        self.create_file('other.txt')
+        gitdir = join(self.directory, '.git')
+
+        def compute():
+            # Listed before another process stages a file
+            res = check_output(['git', 'ls-files', '-z'])
+            check_call(['git', 'add', 'other.txt'])
+            return res
+
+        disk(gitdir, ('test',), compute)
+        self.assertEqual(self.entries(), [])
+        gitlsfiles()
+        memo.clear()
+        self.assertEqual(
+                gitlsfiles(),
+                set([posix(realpath('root.txt')),
+                     posix(realpath('other.txt'))]))
+
+    def test_version(self):
+        from setuptools_git import calculate_version
+        from setuptools_git.cache import disk, memo
+        from setuptools_git.utils import check_call
+        os.environ['SETUPTOOLS_GIT_DIRTY'] = '0'
+        self.addCleanup(os.environ.pop, 'SETUPTOOLS_GIT_DIRTY')
+        self.create_git_file('root.txt')
+        check_call(['git', 'tag', 'v1.0'])
+        self.assertEqual(calculate_version(), 'v1.0'.encode('ascii'))
+        memo.clear()
+        hits = disk.hits
+        self.assertEqual(calculate_version(), 'v1.0'.encode('ascii'))
+        self.assertEqual(disk.hits, hits + 1)
+        check_call(['git', 'tag', '-d', 'v1.0'])
+        check_call(['git', 'tag', 'v2.0'])
+        self.assertEqual(calculate_version(), 'v2.0'.encode('ascii'))
+
+    def test_dirty_version_not_kept(self):
+        from setuptools_git import calculate_version
+        from setuptools_git.cache import memo
+        from setuptools_git.utils import check_call
+        self.create_git_file('root.txt')
+        check_call(['git', 'tag', 'v1.0'])
+        self.assertEqual(calculate_version(), 'v1.0'.encode('ascii'))
+        self.assertEqual(self.entries(), [])
+        # A later process, after an edit the index knows nothing of
+        memo.clear()
+        fd = open('root.txt', 'at')
+        fd.write('edited\n')
+        fd.close()
+        self.assertEqual(calculate_version(), 'v1.0-dirty'.encode('ascii'))
+
+    def test_size_limit(self):
+        from setuptools_git import gitlsfiles
+        from setuptools_git.cache import memo
+        os.environ['SETUPTOOLS_GIT_DISK_CACHE_SIZE'] = '1'
+        self.create_git_file('root.txt')
+        gitlsfiles()
+        self.assertEqual(self.entries(), [])
+        memo.clear()
+        self.assertEqual(gitlsfiles(), set([posix(realpath('root.txt'))]))
+
+    def test_disabled(self):
+        from setuptools_git import gitlsfiles
+        os.environ['SETUPTOOLS_GIT_DISK_CACHE'] = '0'
+        self.create_git_file('root.txt')
+        gitlsfiles()
+        self.assertEqual(self.entries(), [])
+
+
+class gitrepo_tests(GitTestCase):
+
+    def gitrepo(self, *a, **kw):
+        from setuptools_git import _gitrepo
+        return _gitrepo(*a, **kw)
+
+    def rev_parse(self, *args):
+        from setuptools_git.utils import check_output
+        return check_output(['git', 'rev-parse'] + list(args)).strip()
+
+    def count_launches(self, function, *args):
+        import subprocess
+        launches = []
+        saved = subprocess.Popen
+
+        class Popen(saved):
+            def __init__(self, args, *a, **kw):
+                launches.append(args)
+                saved.__init__(self, args, *a, **kw)
+
+        subprocess.Popen = Popen
+        try:
+            function(*args)
+        finally:
+            subprocess.Popen = saved
+        return launches
+
+    def test_at_repo_root(self):
+        topdir, gitdir = self.gitrepo(self.directory)
+        self.assertEqual(topdir, self.rev_parse('--show-toplevel'))
+        self.assertEqual(gitdir, join(self.directory, '.git'))
+
+    def test_in_subdir(self):
+        self.create_dir('subdir')
+        topdir, gitdir = self.gitrepo(join(self.directory, 'subdir'))
+        self.assertEqual(topdir, self.rev_parse('--show-toplevel'))
+        self.assertEqual(gitdir, join(self.directory, '.git'))
+
+    def test_linked_worktree(self):
+        from setuptools_git.utils import check_call
+        self.create_git_file('root.txt')
+        worktree = join(self.directory, 'worktree')
+        check_call(['git', 'worktree', 'add', '--quiet', '-b', 'other',
+                    worktree])
+        os.chdir(worktree)
+        topdir, gitdir = self.gitrepo('')
+        self.assertEqual(topdir, self.rev_parse('--show-toplevel'))
+        self.assertEqual(gitdir, realpath(fsdecode(self.rev_parse('--git-dir'))))
+
+    def test_git_dir_environment(self):
+        self.create_git_file('root.txt')
+        self.create_dir('subdir')
+        os.environ['GIT_DIR'] = join(self.directory, '.git')
+        os.environ['GIT_WORK_TREE'] = self.directory
+        try:
+            launches = self.count_launches(
+                    self.gitrepo, join(self.directory, 'subdir'))
+            topdir, gitdir = self.gitrepo(join(self.directory, 'subdir'))
+        finally:
+            del os.environ['GIT_DIR']
+            del os.environ['GIT_WORK_TREE']
+        self.assertEqual(len(launches), 1)
+        self.assertEqual(topdir, self.rev_parse('--show-toplevel'))
+        self.assertEqual(gitdir, join(self.directory, '.git'))
+
+    def test_not_a_repository(self):
+        from setuptools_git import gitlsfiles
+        directory = realpath(tempfile.mkdtemp())
+        try:
+            self.assertRaises(OSError, self.gitrepo, directory)
+            self.assertEqual(self.count_launches(gitlsfiles, directory), [])
+        finally:
+            rmtree(directory)
+
+    def test_launches_per_build(self):
+        # What 'setup.py egg_info sdist' asks of us
+        from setuptools_git import listfiles, calculate_version
+        from setuptools_git.utils import check_call
+        self.create_git_file('root.txt')
+        check_call(['git', 'tag', 'v1.0'])
+
+        def build():
+            calculate_version()
+            for i in range(3):
+                list(listfiles(self.directory))
+
+        self.assertEqual(
+                [args[1] for args in self.count_launches(build)],
+                ['describe', 'ls-files'])
+
+
+class python_backend_tests(gitlsfiles_tests):
+
+    def setUp(self):
+        from setuptools_git.cache import memo
+        gitlsfiles_tests.setUp(self)
+        memo.clear()
+        os.environ['SETUPTOOLS_GIT_BACKEND'] = 'python'
+
+    def tearDown(self):
+        del os.environ['SETUPTOOLS_GIT_BACKEND']
+        gitlsfiles_tests.tearDown(self)
+
+    def git(self, *args):
+        from setuptools_git.utils import check_output
+        return check_output(['git'] + list(args))
+
+    def assertSameAsGit(self, prefix=None):
+        from setuptools_git.index import lsfiles
+        for stage in (False, True):
+            args = ['ls-files', '-z']
+            if stage:
+                args.append('--stage')
+            self.assertEqual(
+                    lsfiles(join(self.directory, '.git'), stage),
+                    self.git(*args))
+
+    def test_git_error(self):
+        import setuptools_git
+        from setuptools_git.utils import CalledProcessError
+
+        def do_raise(*args, **kw):
+            raise CalledProcessError(1, 'git')
+
+        self.create_git_file('root.txt')
+        fd = open(join('.git', 'index'), 'wb')
+        fd.write('garbage'.encode('ascii'))
+        fd.close()
+        saved = setuptools_git.check_output
+        setuptools_git.check_output = do_raise
+        try:
+            self.assertEqual(self.gitlsfiles(), set())
+        finally:
+            setuptools_git.check_output = saved
+
+    def test_versions(self):
+        filenames = ['root.txt', 'héhé.html', 'a-rather-long-file-name.txt']
+        self.create_dir(join('subdir', 'nested'))
+        for filename in filenames:
+            self.create_file(filename)
+            self.create_file('subdir', filename)
+            self.create_file('subdir', 'nested', filename)
+        self.git('add', '.')
+        # Intent to add needs an extended flag
+        self.create_file('intent.txt')
+        self.git('add', '-N', 'intent.txt')
+        for version in ('2', '3', '4'):
+            self.git('update-index', '--index-version', version)
+            self.assertSameAsGit()
+
+    def test_fresh_repository(self):
+        self.assertSameAsGit()
+
+    def test_split_index(self):
+        from setuptools_git.index import lsfiles, UnsupportedIndex
+        self.create_git_file('root.txt')
+        self.git('update-index', '--split-index')
+        self.assertRaises(
+                UnsupportedIndex, lsfiles, join(self.directory, '.git'))
+        self.assertEqual(
+                set(self.gitlsfiles()), set([posix(realpath('root.txt'))]))
+
+    def test_scoped(self):
+        from setuptools_git import listfiles
+        self.create_git_file('root.txt')
+        self.create_dir('subdir')
+        self.create_git_file('subdir', 'entry.txt')
+        self.assertEqual(
+                set(listfiles(join(self.directory, 'subdir'))),
+                set(['entry.txt']))
+
+
+class pathdecoder_tests(unittest.TestCase):
+
+    def names(self):
+        if sys.version_info >= (3,):
+            return ['root.txt'.encode('ascii'),
+                    'subdir/h\xe9h\xe9.html'.encode('utf-8'),
+                    'subdir/h\xe9h\xe9.html'.encode('latin-1'),
+                    'e\u0301.txt'.encode('utf-8')]
+        return ['root.txt', 'subdir/h\xc3\xa9h\xc3\xa9.html',
+                'subdir/h\xe9h\xe9.html', 'e\xcc\x81.txt']
+
+    def reference(self, platform, path):
+        from setuptools_git import ntfsdecode
+        if platform == 'win32':
+            return ntfsdecode(path)
+        if platform == 'darwin':
+            path = hfs_quote(path)
+        path = fsdecode(path)
+        if platform == 'darwin':
+            path = decompose(path)
+        return path
+
+    def assertSameAsReference(self, platform, prefix):
+        from setuptools_git import _pathdecoder
+        names = self.names()
+        if platform == 'win32' and sys.platform != 'win32':
+            # Latin-1 only decodes with a Windows code page
+            names = [name for name in names if name != names[2]]
+            if prefix != prefix.decode('utf-8', 'replace').encode('utf-8'):
+                return
+        self.assertEqual(
+                _pathdecoder(platform)(prefix, names),
+                [self.reference(platform, prefix + name) for name in names])
+
+    def test_current_platform(self):
+        from setuptools_git.utils import b
+        self.assertSameAsReference(sys.platform, b('/repo/'))
+
+    def test_darwin(self):
+        from setuptools_git.utils import b
+        self.assertSameAsReference('darwin', b('/repo/'))
+
+    def test_win32(self):
+        from setuptools_git.utils import b
+        self.assertSameAsReference('win32', b('C:/repo/'))
+
+    def test_nonascii_prefix(self):
+        from setuptools_git.utils import b
+        for platform in ('linux', 'darwin', 'win32'):
+            self.assertSameAsReference(platform, b('/d\xe9p\xf4t/', 'utf-8'))
+            self.assertSameAsReference(
+                    platform, b('/d\xe9p\xf4t/', 'latin-1'))
+
+
+class pathtable_tests(unittest.TestCase):
+
+    paths = ['/top/setup.py', '/top/a/b/c/deep.txt', '/top/a/one.txt',
+             '/top/a/two.txt', '/top/x/y.txt']
+
+    def test_membership(self):
+        from setuptools_git import _PathTable
+        table = _PathTable(self.paths, len('/top/'))
+        for path in self.paths:
+            self.assertTrue(path in table)
+        for path in ('/top/a', '/top/a/three.txt', '/top/setup.pyc',
+                     '/top/a/b/deep.txt', '/other/setup.py', ''):
+            self.assertFalse(path in table)
+
+    def test_dirs(self):
+        from setuptools_git import _PathTable
+        table = _PathTable(self.paths, len('/top/'))
+        self.assertEqual(table.dirs, set(['/top/a', '/top/a/b', '/top/a/b/c',
+                                          '/top/x']))
+
+    def test_iteration(self):
+        from setuptools_git import _PathTable
+        table = _PathTable(self.paths, len('/top/'))
+        self.assertEqual(len(table), len(self.paths))
+        self.assertEqual(sorted(table), sorted(self.paths))
+        self.assertEqual(len(_PathTable()), 0)
+
+
+class submodule_tests(GitTestCase):
+
+    def setUp(self):
+        from setuptools_git.cache import memo
+        GitTestCase.setUp(self)
+        memo.clear()
+        self.others = []
+        os.environ['SETUPTOOLS_GIT_SUBMODULES'] = '1'
+
+    def tearDown(self):
+        del os.environ['SETUPTOOLS_GIT_SUBMODULES']
+        GitTestCase.tearDown(self)
+        for directory in self.others:
+            rmtree(directory)
+
+    def git(self, *args):
+        from setuptools_git.utils import check_call
+        check_call(['git', '-c', 'protocol.file.allow=always'] + list(args))
+
+    def new_module(self, *filenames):
+        cwd = os.getcwd()
+        directory = self.new_repo()
+        self.others.append(directory)
+        for filename in filenames:
+            self.create_git_file(filename)
+        os.chdir(cwd)
+        return directory
+
+    def add_module(self, url, path):
+        self.git('submodule', '--quiet', 'add', url, path)
+        self.git('commit', '--quiet', '-m', 'add submodule')
+
+    def test_submodule(self):
+        from setuptools_git import gitlsfiles, listfiles
+        self.create_git_file('root.txt')
+        self.add_module(self.new_module('module.txt'), 'sub')
+        for method in ('walk', 'index'):
+            self.assertEqual(
+                    set(listfiles(method=method)),
+                    set(['root.txt', '.gitmodules',
+                         join('sub', 'module.txt')]))
+        self.assertTrue(posix(realpath('sub/module.txt')) in gitlsfiles())
+
+    def test_commit_in_submodule(self):
+        from setuptools_git import gitlsfiles, listfiles
+        self.create_git_file('root.txt')
+        self.add_module(self.new_module('module.txt'), 'sub')
+        for method in ('walk', 'index'):
+            self.assertFalse(join('sub', 'new.txt') in
+                             listfiles(method=method))
+        os.chdir('sub')
+        self.create_git_file('new.txt')
+        os.chdir(self.directory)
+        for method in ('walk', 'index'):
+            self.assertTrue(join('sub', 'new.txt') in
+                            listfiles(method=method))
+        self.assertTrue(posix(realpath('sub/new.txt')) in gitlsfiles())
+
+    def test_disabled(self):
+        from setuptools_git import listfiles
+        self.create_git_file('root.txt')
+        self.add_module(self.new_module('module.txt'), 'sub')
+        del os.environ['SETUPTOOLS_GIT_SUBMODULES']
+        try:
+            self.assertEqual(
+                    set(listfiles()), set(['root.txt', '.gitmodules']))
+        finally:
+            os.environ['SETUPTOOLS_GIT_SUBMODULES'] = '1'
+
+    def test_nested_submodules(self):
+        from setuptools_git import listfiles
+        inner = self.new_module('inner.txt')
+        outer = self.new_module('outer.txt')
+        os.chdir(outer)
+        self.add_module(inner, 'inner')
+        os.chdir(self.directory)
+        self.create_git_file('root.txt')
+        self.add_module(outer, 'outer')
+        self.git('submodule', '--quiet', 'update', '--init', '--recursive')
+        self.assertEqual(
+                set(listfiles()),
+                set(['root.txt', '.gitmodules',
+                     join('outer', '.gitmodules'),
+                     join('outer', 'outer.txt'),
+                     join('outer', 'inner', 'inner.txt')]))
+
+    def test_itergitlsfiles(self):
+        from setuptools_git import gitlsfiles, itergitlsfiles
+        inner = self.new_module('inner.txt')
+        outer = self.new_module('outer.txt')
+        os.chdir(outer)
+        self.add_module(inner, 'inner')
+        os.chdir(self.directory)
+        self.create_git_file('root.txt')
+        self.add_module(outer, 'outer')
+        self.add_module(self.new_module('module.txt'), 'sub')
+        self.git('submodule', '--quiet', 'update', '--init', '--recursive')
+        files = list(itergitlsfiles(bufsize=16))
+        self.assertEqual(len(files), len(set(files)))
+        self.assertEqual(set(files), gitlsfiles())
+        self.assertTrue(
+                posix(realpath(join('outer', 'inner', 'inner.txt'))) in files)
+
+    def test_uninitialized_submodule(self):
+        from setuptools_git import listfiles
+        self.create_git_file('root.txt')
+        self.add_module(self.new_module('module.txt'), 'sub')
+        self.git('submodule', '--quiet', 'deinit', '--force', 'sub')
+        self.assertEqual(
+                set(listfiles()), set(['root.txt', '.gitmodules']))
+
+    def test_many_submodules(self):
+        from setuptools_git import listfiles
+        self.create_git_file('root.txt')
+        expected = set(['root.txt', '.gitmodules'])
+        for i in range(4):
+            self.add_module(self.new_module('module.txt'), 'sub%d' % i)
+            expected.add(join('sub%d' % i, 'module.txt'))
+        os.environ['SETUPTOOLS_GIT_JOBS'] = '2'
+        try:
+            self.assertEqual(set(listfiles()), expected)
+        finally:
+            del os.environ['SETUPTOOLS_GIT_JOBS']
+
+
+class export_ignore_tests(GitTestCase):
+
+    def setUp(self):
+        from setuptools_git.cache import memo
+        GitTestCase.setUp(self)
+        memo.clear()
+        self.create_git_file('root.txt')
+        self.create_git_file('data.bin')
+        self.create_dir('fixtures', 'big')
+        self.create_git_file('fixtures', 'big', 'blob.txt')
+        self.create_dir('src')
+        self.create_git_file('src', 'module.py')
+        self.create_git_file('src', 'module.bin')
+        fd = open('.gitattributes', 'wt')
+        fd.write('*.bin export-ignore\nfixtures export-ignore\n')
+        fd.close()
+        from setuptools_git.utils import check_call
+        check_call(['git', 'add', '.gitattributes'])
+        check_call(['git', 'commit', '--quiet', '-m', 'add attributes'])
+        os.environ['SETUPTOOLS_GIT_EXPORT_IGNORE'] = '1'
+
+    def tearDown(self):
+        del os.environ['SETUPTOOLS_GIT_EXPORT_IGNORE']
+        GitTestCase.tearDown(self)
+
+    def test_listfiles(self):
+        from setuptools_git import listfiles
+        for method in ('walk', 'index'):
+            self.assertEqual(
+                    set(listfiles(method=method)),
+                    set(['root.txt', '.gitattributes',
+                         join('src', 'module.py')]))
+
+    def test_gitlsfiles(self):
+        from setuptools_git import gitlsfiles
+        self.assertEqual(
+                gitlsfiles(),
+                set([posix(realpath(x)) for x in
+                     ('root.txt', '.gitattributes', 'src/module.py')]))
+
+    def test_itergitlsfiles(self):
+        from setuptools_git import gitlsfiles, itergitlsfiles
+        # Small chunks split the paths over several lookups
+        for bufsize in (65536, 16):
+            self.assertEqual(set(itergitlsfiles(bufsize=bufsize)),
+                             gitlsfiles())
+
+    def test_subdir(self):
+        from setuptools_git import listfiles
+        self.assertEqual(list(listfiles('src')), ['module.py'])
+
+    def test_one_process(self):
+        import setuptools_git
+        from setuptools_git import gitlsfiles
+        launches = []
+        saved = setuptools_git.Popen
+
+        class Popen(saved):
+            def __init__(self, args, **kw):
+                launches.append(args[1])
+                saved.__init__(self, args, **kw)
+
+        setuptools_git.Popen = Popen
+        try:
+            gitlsfiles()
+        finally:
+            setuptools_git.Popen = saved
+        self.assertEqual(launches, ['check-attr'])
+
+    def test_disabled(self):
+        from setuptools_git import listfiles
+        del os.environ['SETUPTOOLS_GIT_EXPORT_IGNORE']
+        try:
+            self.assertEqual(len(list(listfiles())), 6)
+        finally:
+            os.environ['SETUPTOOLS_GIT_EXPORT_IGNORE'] = '1'
+
+
+class helpers_tests(export_ignore_tests):
+
+    def setUp(self):
+        export_ignore_tests.setUp(self)
+        os.environ['SETUPTOOLS_GIT_HELPERS'] = '1'
+        os.environ['SETUPTOOLS_GIT_CACHE'] = '0'
+
+    def tearDown(self):
+        from setuptools_git import helpers
+        helpers.shutdown()
+        del os.environ['SETUPTOOLS_GIT_HELPERS']
+        del os.environ['SETUPTOOLS_GIT_CACHE']
+        os.environ.pop('SETUPTOOLS_GIT_HELPERS_IDLE', None)
+        export_ignore_tests.tearDown(self)
+
+    def test_one_process(self):
+        from setuptools_git import gitlsfiles, helpers
+        gitlsfiles()
+        started = helpers.info()['started']
+        queries = helpers.info()['queries']
+        for i in range(3):
+            self.test_gitlsfiles()
+        self.assertEqual(helpers.info()['started'], started)
+        self.assertEqual(helpers.info()['queries'], queries + 3)
+
+    def test_index_change(self):
+        from setuptools_git import gitlsfiles, helpers
+        from setuptools_git.utils import check_call
+        gitlsfiles()
+        started = helpers.info()['started']
+        fd = open('.gitattributes', 'wt')
+        fd.write('*.bin export-ignore\n')
+        fd.close()
+        check_call(['git', 'add', '.gitattributes'])
+        self.assertTrue(
+                posix(realpath(join('fixtures', 'big', 'blob.txt')))
+                in gitlsfiles())
+        self.assertEqual(helpers.info()['started'], started + 1)
+        self.assertEqual(helpers.info()['running'], 1)
+
+    def test_large_query(self):
+        from setuptools_git import gitlsfiles
+        from setuptools_git.utils import check_call
+        for i in range(500):
+            self.create_file('src', 'a-rather-long-module-name-%d.py' % i)
+        check_call(['git', 'add', 'src'])
+        self.assertEqual(len(gitlsfiles()), 503)
+
+    def test_idle(self):
+        import time
+        from setuptools_git import gitlsfiles, helpers
+        os.environ['SETUPTOOLS_GIT_HELPERS_IDLE'] = '0.1'
+        gitlsfiles()
+        for i in range(50):
+            if not helpers.info()['running']:
+                break
+            time.sleep(0.1)
+        self.assertEqual(helpers.info()['running'], 0)
+        self.test_gitlsfiles()
+
+    def test_helper_gone(self):
+        from setuptools_git import gitlsfiles, helpers
+        gitlsfiles()
+        for helper in list(helpers._helpers.values()):
+            helper.process.kill()
+            helper.process.wait()
+        started = helpers.info()['started']
+        # Answered by a Git of its own, then by a new helper
+        self.test_gitlsfiles()
+        self.test_gitlsfiles()
+        self.assertEqual(helpers.info()['started'], started + 1)
+
+    def test_idle_close_unlocked(self):
+        import time
+        from setuptools_git import gitlsfiles, helpers
+        os.environ['SETUPTOOLS_GIT_HELPERS_IDLE'] = '0.1'
+        locked = []
+        gitlsfiles()
+        for helper in list(helpers._helpers.values()):
+            def close(close=helper.close):
+                locked.append(helpers._lock.locked())
+                close()
+            helper.close = close
+        for i in range(50):
+            if locked:
+                break
+            time.sleep(0.1)
+        self.assertEqual(locked, [False])
+
+    def test_fork(self):
+        import time
+        import threading
+        from setuptools_git import gitlsfiles, helpers
+        os.environ['SETUPTOOLS_GIT_HELPERS_IDLE'] = '0.1'
+        gitlsfiles()
+        parent = list(helpers._helpers.values())
+        # What a child process finds: helpers and a reaper of the parent
+        pid, reaper = helpers._pid, helpers._reaper
+        helpers._pid = -1
+        helpers._reaper = threading.Thread(target=lambda: None)
+        try:
+            self.test_gitlsfiles()
+            self.assertFalse(set(helpers._helpers.values()) & set(parent))
+            for i in range(50):
+                if not helpers.info()['running']:
+                    break
+                time.sleep(0.1)
+            self.assertEqual(helpers.info()['running'], 0)
+        finally:
+            helpers._pid = pid
+            for helper in parent:
+                helper.close()
+            if reaper is not None:
+                reaper.join()
+
+
+class incremental_tests(GitTestCase):
+
+    def setUp(self):
+        from setuptools_git import trace
+        GitTestCase.setUp(self)
+        self.create_dir('a', 'b')
+        self.create_git_file('a', 'b', 'file.txt')
+        self.create_git_file('a', 'other.txt')
+        self.create_dir('untracked')
+        os.environ['SETUPTOOLS_GIT_INCREMENTAL'] = '1'
+        trace.enable(os.devnull)
+
+    def tearDown(self):
+        from setuptools_git import trace
+        trace.disable()
+        del os.environ['SETUPTOOLS_GIT_INCREMENTAL']
+        GitTestCase.tearDown(self)
+
+    def age(self):
+        # Make the directories old enough to be remembered
+        past = os.stat('.').st_mtime - 60
+        for root, dirs, files in os.walk('.'):
+            os.utime(root, (past, past))
+
+    def listfiles(self):
+        from setuptools_git import listfiles, trace
+        from setuptools_git.cache import memo
+        memo.clear()
+        del trace.events[:]
+        res = set(listfiles())
+        walk, = [x for x in trace.events if x['phase'] == 'walk']
+        return res, walk
+
+    def test_reuse(self):
+        self.age()
+        res, walk = self.listfiles()
+        self.assertEqual(walk['listed'], 3)
+        self.assertEqual(res, self.listfiles()[0])
+        walk = self.listfiles()[1]
+        self.assertEqual((walk['listed'], walk['reused']), (0, 3))
+        self.assertEqual(walk['lstats'], 0)
+
+    def test_recent_directories_listed_again(self):
+        self.listfiles()
+        walk = self.listfiles()[1]
+        self.assertEqual((walk['listed'], walk['reused']), (3, 0))
+
+    def test_new_file(self):
+        self.age()
+        self.listfiles()
+        self.create_git_file('a', 'b', 'new.txt')
+        res, walk = self.listfiles()
+        self.assertEqual((walk['listed'], walk['reused']), (1, 2))
+        self.assertTrue(join('a', 'b', 'new.txt') in res)
+
+    def test_removed_file(self):
+        self.age()
+        self.listfiles()
+        os.remove(join('a', 'other.txt'))
+        res, walk = self.listfiles()
+        self.assertEqual(res, set([join('a', 'b', 'file.txt')]))
+
+    def test_retargeted_symlink(self):
+        self.create_dir('c')
+        self.create_git_file('c', 'c.txt')
+        os.symlink('b', join('a', 'link'))
+        self.age()
+        res = self.listfiles()[0]
+        self.assertTrue(join('a', 'link', 'file.txt') in res)
+        # Replace the link without the mtime of its directory moving on
+        past = os.stat('a').st_mtime
+        os.remove(join('a', 'link'))
+        os.symlink(join(os.pardir, 'c'), join('a', 'link'))
+        os.utime('a', (past, past))
+        res = self.listfiles()[0]
+        self.assertTrue(join('a', 'link', 'c.txt') in res)
+        self.assertFalse(join('a', 'link', 'file.txt') in res)
+
+
+class sparse_tests(GitTestCase):
+
+    def setUp(self):
+        from setuptools_git.cache import memo
+        from setuptools_git.utils import CalledProcessError
+        GitTestCase.setUp(self)
+        memo.clear()
+        self.create_git_file('root.txt')
+        self.create_dir('inside')
+        self.create_git_file('inside', 'entry.txt')
+        self.create_dir('outside', 'deeper')
+        self.create_git_file('outside', 'other.txt')
+        self.create_git_file('outside', 'deeper', 'third.txt')
+        try:
+            self.git('sparse-checkout', 'set', 'inside')
+        except CalledProcessError:
+            self.skipTest('git without sparse-checkout')
+        memo.clear()
+
+    def git(self, *args):
+        from setuptools_git.utils import check_output
+        devnull = open(os.devnull, 'w')
+        try:
+            return check_output(['git'] + list(args), stderr=devnull)
+        finally:
+            devnull.close()
+
+    def expected(self):
+        return set(['root.txt', join('inside', 'entry.txt')])
+
+    def test_layout(self):
+        self.assertFalse(os.path.exists('outside'))
+
+    def test_gitlsfiles(self):
+        from setuptools_git import gitlsfiles, itergitlsfiles
+        expected = set([posix(realpath(x)) for x in self.expected()])
+        self.assertEqual(gitlsfiles(), expected)
+        self.assertEqual(set(itergitlsfiles()), expected)
+
+    def test_gitlsdirs(self):
+        from setuptools_git import gitlsdirs
+        self.assertEqual(gitlsdirs(), set([posix(realpath('inside'))]))
+
+    def test_listfiles(self):
+        from setuptools_git import listfiles
+        for method in ('walk', 'index'):
+            self.assertEqual(set(listfiles(method=method)), self.expected())
+
+    def test_python_backend(self):
+        from setuptools_git.index import lsfiles
+        gitdir = join(self.directory, '.git')
+        self.assertEqual(lsfiles(gitdir, tags=True),
+                         self.git('ls-files', '-z', '-t'))
+        self.assertEqual(lsfiles(gitdir, True, tags=True),
+                         self.git('ls-files', '-z', '-t', '--stage'))
+
+    def test_untracked_directory_pruned(self):
+        from setuptools_git import listfiles, trace
+        # Build output where the skipped files would be; Git would
+        # count a skipped file found on disk as checked out again
+        self.create_dir('outside')
+        self.create_file('outside', 'build.o')
+        trace.enable(os.devnull)
+        try:
+            self.assertEqual(set(listfiles()), self.expected())
+            walk, = [x for x in trace.events if x['phase'] == 'walk']
+            decode, = [x for x in trace.events if x['phase'] == 'decode']
+        finally:
+            trace.disable()
+        self.assertEqual(walk['directories'], 2)
+        self.assertEqual(decode['skipped'], 2)
+
+    def test_not_sparse(self):
+        from setuptools_git import gitlsfiles
+        from setuptools_git.cache import memo
+        self.git('sparse-checkout', 'disable')
+        memo.clear()
+        self.assertEqual(len(gitlsfiles()), 4)
+
+
+class partial_clone_tests(GitTestCase):
+
+    def setUp(self):
+        from setuptools_git.utils import check_call
+        from setuptools_git.utils import CalledProcessError
+        GitTestCase.setUp(self)
+        self.create_dir('inside')
+        self.create_git_file('inside', 'entry.txt')
+        self.create_dir('outside')
+        self.create_git_file('outside', 'other.txt')
+        fd = open(join('outside', '.gitattributes'), 'wt')
+        fd.write('*.txt export-ignore\n')
+        fd.close()
+        check_call(['git', 'add', '.'])
+        check_call(['git', 'commit', '--quiet', '-m', 'add attributes'])
+        check_call(['git', 'tag', 'v1.0'])
+        check_call(['git', 'config', 'uploadpack.allowFilter', 'true'])
+        self.source = self.directory
+        self.directory = realpath(tempfile.mkdtemp())
+        devnull = open(os.devnull, 'w')
+        try:
+            check_call(['git', 'clone', '--quiet', '--sparse',
+                        '--filter=blob:none', 'file://' + self.source,
+                        join(self.directory, 'clone')],
+                       stdout=devnull, stderr=devnull)
+            os.chdir(join(self.directory, 'clone'))
+            check_call(['git', 'sparse-checkout', 'set', 'inside'],
+                       stdout=devnull, stderr=devnull)
+        except CalledProcessError:
+            self.skipTest('git without partial clones')
+        finally:
+            devnull.close()
+
+    def tearDown(self):
+        GitTestCase.tearDown(self)
+        rmtree(self.source)
+
+    def missing(self):
+        from setuptools_git.utils import check_output
+        objects = check_output(['git', 'rev-list', '--objects', '--all',
+                                '--missing=print'])
+        return [x for x in objects.splitlines() if x.startswith(b('?'))]
+
+    def test_no_fetch(self):
+        from setuptools_git import calculate_version, gitlsfiles, listfiles
+        from setuptools_git.cache import memo
+        missing = self.missing()
+        self.assertTrue(missing)
+        os.environ['SETUPTOOLS_GIT_EXPORT_IGNORE'] = '1'
+        try:
+            memo.clear()
+            self.assertEqual(len(gitlsfiles()), 1)
+            for method in ('walk', 'index'):
+                self.assertEqual(list(listfiles(method=method)),
+                                 [join('inside', 'entry.txt')])
+            self.assertEqual(calculate_version(), b('v1.0'))
+        finally:
+            del os.environ['SETUPTOOLS_GIT_EXPORT_IGNORE']
+        self.assertEqual(self.missing(), missing)
+
+    def test_environment(self):
+        from setuptools_git import _gitenv
+        gitdir = join(self.directory, 'clone', '.git')
+        self.assertEqual(_gitenv(gitdir)['GIT_NO_LAZY_FETCH'], '1')
+        self.assertEqual(_gitenv(join(self.source, '.git')), None)
+
+
+class tree_tests(GitTestCase):
+
+    def setUp(self):
+        from setuptools_git.cache import memo
+        from setuptools_git.utils import check_call
+        GitTestCase.setUp(self)
+        memo.clear()
+        self.create_git_file('root.txt')
+        self.create_dir('sub')
+        self.create_git_file('sub', 'entry.txt')
+        check_call(['git', 'tag', 'v1.0'])
+        self.create_git_file('sub', 'later.txt')
+        # Work tree and index both differ from HEAD
+        os.remove('root.txt')
+        self.create_file('staged.txt')
+        check_call(['git', 'add', 'staged.txt'])
+        self.create_dir('build')
+        self.create_file('build', 'clutter.o')
+
+    def tearDown(self):
+        os.environ.pop('SETUPTOOLS_GIT_REVISION', None)
+        GitTestCase.tearDown(self)
+
+    def test_head(self):
+        from setuptools_git import listfiles
+        self.assertEqual(
+                set(listfiles(method='tree')),
+                set(['root.txt', join('sub', 'entry.txt'),
+                     join('sub', 'later.txt')]))
+
+    def test_revision(self):
+        from setuptools_git import listfiles
+        os.environ['SETUPTOOLS_GIT_REVISION'] = 'v1.0'
+        self.assertEqual(set(listfiles()),
+                         set(['root.txt', join('sub', 'entry.txt')]))
+        self.assertEqual(list(listfiles('sub')), ['entry.txt'])
+
+    def test_revision_moves(self):
+        from setuptools_git import listfiles
+        from setuptools_git.utils import check_output
+        os.environ['SETUPTOOLS_GIT_REVISION'] = 'v1.0'
+        self.assertEqual(len(list(listfiles())), 2)
+        check_output(['git', 'tag', '--force', 'v1.0', 'HEAD'])
+        self.assertEqual(len(list(listfiles())), 3)
+
+    def test_unknown_revision(self):
+        from setuptools_git import listfiles
+        os.environ['SETUPTOOLS_GIT_REVISION'] = 'no-such-tag'
+        self.assertEqual(list(listfiles()), [])
+
+    def test_listfiles_many(self):
+        from setuptools_git import listfiles_many
+        os.environ['SETUPTOOLS_GIT_REVISION'] = 'v1.0'
+        self.assertEqual(listfiles_many(['sub']), {'sub': ['entry.txt']})
+
+    def test_calculate_version(self):
+        from setuptools_git import calculate_version
+        self.assertTrue(calculate_version().startswith(b('v1.0-1-g')))
+        os.environ['SETUPTOOLS_GIT_REVISION'] = 'v1.0'
+        self.assertEqual(calculate_version(), b('v1.0'))
+
+    def test_export_ignore_from_revision(self):
+        from setuptools_git import listfiles, stage
+        from setuptools_git.utils import check_call
+        os.environ['SETUPTOOLS_GIT_EXPORT_IGNORE'] = '1'
+        self.addCleanup(os.environ.pop, 'SETUPTOOLS_GIT_EXPORT_IGNORE')
+        # Attributes that v1.0 does not have
+        fd = open('.gitattributes', 'wt')
+        fd.write('sub export-ignore\n')
+        fd.close()
+        check_call(['git', 'add', '.gitattributes'])
+        check_call(['git', 'commit', '--quiet', '-m', 'ignore sub'])
+        os.environ['SETUPTOOLS_GIT_REVISION'] = 'v1.0'
+        expected = set(['root.txt', join('sub', 'entry.txt')])
+        self.assertEqual(set(listfiles()), expected)
+        directory = stage('v1.0')
+        try:
+            found = set()
+            for root, dirs, files in os.walk(directory):
+                found.update(join(root, x)[len(directory) + 1:]
+                             for x in files)
+            self.assertEqual(found, expected)
+        finally:
+            rmtree(directory)
+        os.environ['SETUPTOOLS_GIT_REVISION'] = 'HEAD'
+        self.assertEqual(set(listfiles()),
+                         set(['.gitattributes', 'root.txt', 'staged.txt']))
+
+    def test_stage(self):
+        from setuptools_git import stage
+        directory = stage('v1.0')
+        try:
+            found = set()
+            for root, dirs, files in os.walk(directory):
+                found.update(join(root, x)[len(directory) + 1:]
+                             for x in files)
+            self.assertEqual(found,
+                             set(['root.txt', join('sub', 'entry.txt')]))
+        finally:
+            rmtree(directory)
+
+    def test_stage_subdir(self):
+        from setuptools_git import stage
+        # The whole tree, wherever in it dirname is
+        directory = stage(dirname='sub')
+        try:
+            self.assertEqual(sorted(os.listdir(directory)),
+                             ['root.txt', 'sub'])
+            self.assertEqual(sorted(os.listdir(join(directory, 'sub'))),
+                             ['entry.txt', 'later.txt'])
+        finally:
+            rmtree(directory)
+
+    def test_stage_unknown_revision(self):
+        from setuptools_git import stage
+        from setuptools_git.utils import CalledProcessError
+        directory = realpath(tempfile.mkdtemp())
+        try:
+            self.assertRaises(CalledProcessError, stage, 'no-such-tag',
+                              directory=directory)
+        finally:
+            rmtree(directory)
+
+    def test_build_in_stage(self):
+        from setuptools_git import listfiles, stage
+        from setuptools_git.cache import memo
+        directory = stage('v1.0')
+        os.environ['SETUPTOOLS_GIT_REVISION'] = 'v1.0'
+        os.environ['GIT_DIR'] = join(self.directory, '.git')
+        try:
+            os.chdir(directory)
+            memo.clear()
+            self.assertEqual(set(listfiles()),
+                             set(['root.txt', join('sub', 'entry.txt')]))
+        finally:
+            del os.environ['GIT_DIR']
+            os.chdir(self.directory)
+            rmtree(directory)
+
+    def test_build_in_stage_subdir(self):
+        from setuptools_git import calculate_version, listfiles, stage
+        from setuptools_git.cache import memo
+        directory = stage('v1.0', 'sub')
+        os.environ['SETUPTOOLS_GIT_REVISION'] = 'v1.0'
+        os.environ['GIT_DIR'] = join(self.directory, '.git')
+        os.environ['GIT_WORK_TREE'] = directory
+        try:
+            os.chdir(join(directory, 'sub'))
+            memo.clear()
+            res = list(listfiles())
+            self.assertEqual(res, ['entry.txt'])
+            self.assertTrue(os.path.isfile(res[0]))
+            self.assertEqual(calculate_version(), b('v1.0'))
+        finally:
+            del os.environ['GIT_DIR']
+            del os.environ['GIT_WORK_TREE']
+            os.chdir(self.directory)
+            rmtree(directory)
+
+
+class calculate_version_tests(GitTestCase):
+
+    def setUp(self):
+        from setuptools_git.cache import memo
+        from setuptools_git.utils import check_call
+        GitTestCase.setUp(self)
+        memo.clear()
+        self.create_git_file('root.txt')
+        check_call(['git', 'tag', 'v1.0'])
+
+    def calculate_version(self):
+        from setuptools_git import calculate_version
+        return calculate_version().decode('ascii')
+
+    def test_tag(self):
+        self.assertEqual(self.calculate_version(), 'v1.0')
+
+    def test_cached(self):
+        import setuptools_git
+        calls = []
+
+        def record(args, **kw):
+            calls.append(args)
+            return saved(args, **kw)
+
+        saved = setuptools_git.check_output
+        setuptools_git.check_output = record
+        try:
+            self.assertEqual(self.calculate_version(), 'v1.0')
+            self.assertEqual(self.calculate_version(), 'v1.0')
+        finally:
+            setuptools_git.check_output = saved
+        self.assertEqual(len(calls), 1)
+
+    def test_new_tag(self):
+        from setuptools_git.utils import check_call
+        self.assertEqual(self.calculate_version(), 'v1.0')
+        check_call(['git', 'tag', '-d', 'v1.0'])
+        check_call(['git', 'tag', 'v2.0'])
+        self.assertEqual(self.calculate_version(), 'v2.0')
+
+    def test_dirty(self):
+        fd = open('root.txt', 'at')
+        fd.write('changed\n')
+        fd.close()
+        self.assertEqual(self.calculate_version(), 'v1.0-dirty')
+
+    def test_dirty_check_disabled(self):
+        fd = open('root.txt', 'at')
+        fd.write('changed\n')
+        fd.close()
+        os.environ['SETUPTOOLS_GIT_DIRTY'] = '0'
+        try:
+            self.assertEqual(self.calculate_version(), 'v1.0')
+        finally:
+            del os.environ['SETUPTOOLS_GIT_DIRTY']
+
+    def test_stats(self):
+        from setuptools_git import versionstats
+        calls, seconds = versionstats['calls'], versionstats['seconds']
+        self.calculate_version()
+        self.assertEqual(versionstats['calls'], calls + 1)
+        self.assertTrue(versionstats['seconds'] > seconds)
+
+    def test_version_calc(self):
+        from setuptools_git import version_calc
+
+        class Metadata(object):
+            version = None
+
+        class Distribution(object):
+            metadata = Metadata()
+
+        dist = Distribution()
+        version_calc(dist, 'use_vcs_version', False)
+        self.assertEqual(dist.metadata.version, None)
+        version_calc(dist, 'use_vcs_version', True)
+        self.assertEqual(dist.metadata.version, 'v1.0'.encode('ascii'))
+
+
+class scan_tests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = realpath(tempfile.mkdtemp())
+        os.makedirs(join(self.directory, 'src', 'pkg'))
+        os.makedirs(join(self.directory, 'build'))
+        for path in (('src', 'a.py'), ('src', 'pkg', 'b.py'),
+                     ('build', 'c.o'), ('setup.py',)):
+            fd = open(join(self.directory, *path), 'wt')
+            fd.close()
+        os.symlink('src', join(self.directory, 'dirlink'))
+        os.symlink('setup.py', join(self.directory, 'filelink'))
+        os.symlink('missing', join(self.directory, 'dangling'))
+
+    def tearDown(self):
+        rmtree(self.directory)
+
+    def test_listdir(self):
+        from setuptools_git import scan
+        counters = scan.counters()
+        dirs, files, links = scan.listdir(self.directory, counters)
+        self.assertEqual(sorted(dirs), ['build', 'src'])
+        self.assertEqual(files, ['setup.py'])
+        self.assertEqual(sorted(links), ['dangling', 'dirlink', 'filelink'])
+        self.assertEqual(counters['directories'], 1)
+        self.assertEqual(counters['entries'], 6)
+
+    def test_wanted(self):
+        from setuptools_git import scan
+        counters = scan.counters()
+        dirs, files, links = scan.listdir(
+                self.directory, counters, lambda name: name != 'build')
+        self.assertEqual(dirs, ['src'])
+        self.assertEqual(len(links), 3)
+        self.assertEqual(counters['skipped'], 1)
+
+    def test_missing(self):
+        from setuptools_git import scan
+        self.assertEqual(scan.listdir(join(self.directory, 'missing')),
+                         ([], [], []))
+
+    def walk(self, wanted=None):
+        from setuptools_git import scan
+        counters = scan.counters()
+        res = {}
+        for root, dirs, files, links in scan.walk(self.directory, counters,
+                                                  wanted):
+            if 'dirlink' in dirs:
+                dirs.remove('dirlink')
+            res[root[len(self.directory):]] = (
+                sorted(dirs), sorted(files), sorted(links))
+        return res, counters
+
+    def test_walk(self):
+        res, counters = self.walk()
+        self.assertEqual(
+                res[''], (['build', 'src'],
+                          ['dangling', 'filelink', 'setup.py'],
+                          ['dangling', 'dirlink', 'filelink']))
+        self.assertEqual(sorted(res), ['', '/build', '/src', '/src/pkg'])
+        self.assertEqual(counters['directories'], 4)
+        # One stat per link to tell where it points, none otherwise
+        self.assertEqual(counters['stats'], 3)
+
+    def test_walk_wanted(self):
+        def wanted(root, name):
+            return name != 'build'
+
+        res, counters = self.walk(wanted)
+        self.assertEqual(sorted(res), ['', '/src', '/src/pkg'])
+        self.assertEqual(counters['skipped'], 1)
+
+    def test_fallback(self):
+        from setuptools_git import scan
+        saved = scan.scandir
+        scan.scandir = None
+        try:
+            fallback = self.walk()
+        finally:
+            scan.scandir = saved
+        self.assertEqual(fallback[0], self.walk()[0])
+        self.assertTrue(fallback[1]['stats'] > self.walk()[1]['stats'])
+
+
+class trace_tests(GitTestCase):
+
+    def setUp(self):
+        from setuptools_git import trace
+        from setuptools_git.cache import memo
+        GitTestCase.setUp(self)
+        memo.clear()
+        self.create_dir('a', 'b')
+        self.create_git_file('a', 'b', 'file.txt')
+        self.create_dir('untracked')
+        trace.enable(join(self.directory, 'trace.json'))
+
+    def tearDown(self):
+        from setuptools_git import trace
+        trace.disable()
+        GitTestCase.tearDown(self)
+
+    def phases(self, name):
+        from setuptools_git import trace
+        return [event for event in trace.events if event['phase'] == name]
+
+    def test_disabled(self):
+        from setuptools_git import trace, listfiles
+        trace.disable()
+        list(listfiles())
+        self.assertEqual(trace.events, [])
+        self.assertFalse(trace.enabled())
+
+    def test_walk(self):
+        from setuptools_git import listfiles
+        self.assertEqual(list(listfiles()), [join('a', 'b', 'file.txt')])
+        walk, = self.phases('walk')
+        self.assertEqual(walk['directories'], 3)
+        # .git and untracked, passed over by name or once seen
+        self.assertEqual(walk['pruned'] + walk.get('skipped', 0), 2)
+        self.assertEqual(walk['lstats'], 0)
+        self.assertEqual(walk['realpaths'], 0)
+        self.assertEqual(self.phases('listfiles')[0]['paths'], 1)
+        self.assertEqual(self.phases('decode')[0]['paths'], 1)
+        self.assertEqual(len(self.phases('ls-files')), 1)
+
+    def test_walk_untracked(self):
+        from setuptools_git import listfiles, scan
+        if scan.scandir is None:
+            self.skipTest('os.scandir is missing')
+        self.create_dir('a', 'b', 'build')
+        for i in range(10):
+            self.create_file('a', 'b', 'output%d.o' % i)
+        self.assertEqual(list(listfiles()), [join('a', 'b', 'file.txt')])
+        walk, = self.phases('walk')
+        self.assertEqual(walk['directories'], 3)
+        self.assertEqual(walk['skipped'], 13)
+        self.assertEqual((walk['lstats'], walk['stats']), (0, 0))
+
+    def test_index(self):
+        from setuptools_git import listfiles
+        list(listfiles(method='index'))
+        self.assertEqual(self.phases('index')[0]['paths'], 1)
+        self.assertEqual(self.phases('ls-files')[0]['args'], ['--stage'])
+
+    def test_describe(self):
+        from setuptools_git import calculate_version
+        from setuptools_git.utils import check_call
+        check_call(['git', 'tag', 'v1.0'])
+        calculate_version()
+        self.assertEqual(len(self.phases('describe')), 1)
+        self.assertEqual(self.phases('discover')[0]['git'], False)
+
+    def test_report(self):
+        import json
+        from setuptools_git import trace, listfiles
+        list(listfiles())
+        trace._report()
+        fd = open(join(self.directory, 'trace.json'))
+        try:
+            lines = [json.loads(line) for line in fd]
+        finally:
+            fd.close()
+        self.assertEqual(lines[:-1], trace.events)
+        self.assertEqual(lines[-1]['summary']['walk']['calls'], 1)
+        self.assertTrue('misses' in lines[-1]['memo'])
+
+
+@unittest.skipIf(sys.version_info < (3, 7), 'asyncio.run is required')
+class aio_tests(GitTestCase):
+
+    def setUp(self):
+        from setuptools_git.cache import memo
+        GitTestCase.setUp(self)
+        memo.clear()
+        self.create_git_file('root.txt')
+        for name in ('one', 'two', 'three'):
+            self.create_dir(name)
+            self.create_git_file(name, 'module.py')
+
+    def run_async(self, *coroutines):
+        import asyncio
+
+        async def gather():
+            return await asyncio.gather(*coroutines)
+
+        return asyncio.run(gather())
+
+    def test_gitlsfiles(self):
+        from setuptools_git import gitlsfiles
+        from setuptools_git.aio import async_gitlsfiles
+        res, = self.run_async(async_gitlsfiles())
+        self.assertEqual(res, gitlsfiles())
+
+    def test_listfiles(self):
+        from setuptools_git import listfiles
+        from setuptools_git.aio import async_listfiles
+        for method in ('walk', 'index'):
+            res = self.run_async(*[async_listfiles(name, method)
+                                   for name in ('one', 'two', 'three', '')])
+            self.assertEqual(res[:3], [['module.py']] * 3)
+            self.assertEqual(sorted(res[3]), sorted(listfiles()))
+
+    def test_shared_process(self):
+        from setuptools_git import trace
+        from setuptools_git.aio import async_gitlsfiles
+        trace.enable(os.devnull)
+        try:
+            res = self.run_async(*[async_gitlsfiles(name)
+                                   for name in ('one', 'two', 'three')])
+            processes = [x for x in trace.events if x['phase'] == 'ls-files']
+        finally:
+            trace.disable()
+        self.assertEqual(len(processes), 1)
+        self.assertEqual(res[0], res[2])
+
+    def test_limit(self):
+        from setuptools_git.aio import async_listfiles
+        os.environ['SETUPTOOLS_GIT_JOBS'] = '1'
+        try:
+            res = self.run_async(*[async_listfiles(name)
+                                   for name in ('one', 'two', 'three')])
+        finally:
+            del os.environ['SETUPTOOLS_GIT_JOBS']
+        self.assertEqual(res, [['module.py']] * 3)
+
+    def test_calculate_version(self):
+        from setuptools_git.aio import async_calculate_version
+        from setuptools_git.utils import check_call
+        check_call(['git', 'tag', 'v1.0'])
+        os.chdir(self.old_cwd)
+        res = self.run_async(async_calculate_version(self.directory),
+                             async_calculate_version(self.directory))
+        self.assertEqual(res, [b('v1.0'), b('v1.0')])
+
+    def test_calculate_version_disk_cache(self):
+        from setuptools_git.aio import async_calculate_version
+        from setuptools_git.cache import memo
+        from setuptools_git.utils import check_call
+        check_call(['git', 'tag', 'v1.0'])
+        os.environ['SETUPTOOLS_GIT_DISK_CACHE'] = '1'
+        self.addCleanup(os.environ.pop, 'SETUPTOOLS_GIT_DISK_CACHE')
+        self.assertEqual(self.run_async(async_calculate_version()),
+                         [b('v1.0')])
+        memo.clear()
+        self.create_file('root.txt')
+        fd = open('root.txt', 'at')
+        fd.write('edited\n')
+        fd.close()
+        self.assertEqual(self.run_async(async_calculate_version()),
+                         [b('v1.0-dirty')])
+
+    def test_not_a_repository(self):
+        from setuptools_git.utils import CalledProcessError
+        from setuptools_git.aio import async_gitlsfiles
+        from setuptools_git.aio import async_calculate_version
+        directory = realpath(tempfile.mkdtemp())
+        os.environ['GIT_CEILING_DIRECTORIES'] = os.path.dirname(directory)
+        try:
+            self.assertEqual(self.run_async(async_gitlsfiles(directory)),
+                             [set()])
+            self.assertRaises(CalledProcessError, self.run_async,
+                              async_calculate_version(directory))
+        finally:
+            del os.environ['GIT_CEILING_DIRECTORIES']
+            rmtree(directory)
+
+
+class main_tests(GitTestCase):
+
+    def setUp(self):
+        from setuptools_git.cache import memo
+        GitTestCase.setUp(self)
+        memo.clear()
+        self.create_git_file('root.txt')
+        self.create_dir('sub')
+        self.create_git_file('sub', 'entry.txt')
+
+    def main(self, *args):
+        import io
+        from setuptools_git.__main__ import main
+
+        class Stream(object):
+            def __init__(self):
+                self.buffer = io.BytesIO()
+
+            def write(self, data):
+                self.buffer.write(data.encode('utf-8'))
+
+            def flush(self):
+                pass
+
+        saved = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = Stream(), Stream()
+        try:
+            self.status = main(list(args))
+            return sys.stdout.buffer.getvalue(), sys.stderr.buffer.getvalue()
+        finally:
+            sys.stdout, sys.stderr = saved
+
+    def test_lines(self):
+        out = self.main()[0]
+        self.assertEqual(
+                sorted(out.splitlines()),
+                sorted([b('root.txt'), b(join('sub', 'entry.txt'))]))
+
+    def test_nul(self):
+        out = self.main('-z', 'sub')[0]
+        self.assertEqual(out, b('entry.txt\x00'))
+
+    def test_revision(self):
+        from setuptools_git.utils import check_call
+        check_call(['git', 'tag', 'v1.0'])
+        self.create_git_file('later.txt')
+        try:
+            out = self.main('--revision', 'v1.0')[0]
+        finally:
+            del os.environ['SETUPTOOLS_GIT_REVISION']
+        self.assertEqual(
+                sorted(out.splitlines()),
+                sorted([b('root.txt'), b(join('sub', 'entry.txt'))]))
+
+    def test_json(self):
+        import json
+        out = self.main('--json', '--method', 'index', 'sub')[0]
+        self.assertEqual([json.loads(line.decode('ascii'))
+                          for line in out.splitlines()],
+                         [{'path': 'entry.txt'}])
+
+    def test_version(self):
+        from setuptools_git.utils import check_call
+        check_call(['git', 'tag', 'v1.0'])
+        out, err = self.main('--version', '--stats')
+        self.assertEqual(out, b('v1.0\n'))
+        self.assertTrue(b('version_seconds') in err)
+
+    def test_version_without_tags(self):
+        out, err = self.main('--version')
+        self.assertEqual(self.status, 1)
+        self.assertEqual(out, b(''))
+        self.assertEqual(len(err.splitlines()), 1)
+        self.assertTrue(err.startswith(b('python -m setuptools_git: ')))
+
+    def test_version_not_a_repository(self):
+        directory = realpath(tempfile.mkdtemp())
+        os.environ['GIT_CEILING_DIRECTORIES'] = os.path.dirname(directory)
+        try:
+            self.main('--version', directory)
+        finally:
+            del os.environ['GIT_CEILING_DIRECTORIES']
+            os.chdir(self.directory)
+            rmtree(directory)
+        self.assertEqual(self.status, 1)
+
+    def test_stats(self):
+        import json
+        err = self.main('--stats')[1]
+        self.assertEqual(json.loads(err.decode('ascii'))['files'], 2)
+
+
+class import_tests(unittest.TestCase):
+
+    # Modules that must not be loaded just because setuptools loads the
+    # entry points of the plugin
+    heavy = ['shutil', 'unicodedata', 'urllib.parse', 'concurrent.futures',
+             'hashlib', 'tempfile', 'json', 'logging', 'mmap',
+             'setuptools_git.index', 'setuptools_git.aio',
+             'setuptools_git.helpers']
+
+    def loaded(self, code):
+        import subprocess
+        from setuptools_git.utils import check_output
+        script = (
+            'import sys\n'
+            'before = set(sys.modules)\n'
+            '%s\n'
+            'print(" ".join(sorted(set(sys.modules) - before)))\n' % code)
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__)))
+        return check_output([sys.executable, '-c', script],
+                            env=env).decode('ascii').split()
+
+    def test_import(self):
+        loaded = self.loaded('import setuptools_git')
+        self.assertTrue('setuptools_git' in loaded)
+        for name in self.heavy:
+            self.assertFalse(name in loaded, name)
+
+    def test_version_calc_disabled(self):
+        loaded = self.loaded(
+            'from setuptools_git import version_calc\n'
+            'version_calc(None, "use_vcs_version", False)')
+        for name in self.heavy:
+            self.assertFalse(name in loaded, name)
+
+
+class benchmark_tests(unittest.TestCase):
+
+    def test_run(self):
+        from setuptools_git.benchmark import Shape, run, compare
+        shape = Shape(files=30, depth=2, width=3, nonascii=0.5,
+                      symlinks=1, untracked=5)
+        res = run(shape, repeat=1)
+        self.assertEqual(res['shape']['files'], 30)
+        self.assertEqual(
+                sorted(res['results']),
+                ['calculate_version', 'gitlsdirs', 'gitlsfiles', 'import',
+                 'itergitlsfiles',
+                 'listfiles[index]', 'listfiles[tree]',
+                 'listfiles[walk]'])
+        for name, result in res['results'].items():
+            self.assertTrue(result['seconds'] >= 0)
+            if name != 'import':
+                self.assertTrue(result['subprocesses'] >= 1, name)
+        self.assertEqual(len(compare(res, res)), 9)
+
+    def test_micro(self):
+        from setuptools_git.benchmark import Shape, micro
+        res = micro(Shape(files=100, depth=4, width=2), repeat=1)
+        self.assertEqual(sorted(res['results']), ['_PathTable', '_ancestors'])
+        for result in res['results'].values():
+            self.assertEqual(result['subprocesses'], 0)
+
+    def test_make_repo(self):
+        from setuptools_git import listfiles
+        from setuptools_git.benchmark import Shape, make_repo
+        directory = realpath(tempfile.mkdtemp())
+        try:
+            top = make_repo(Shape(files=12, depth=1, width=2, submodules=1),
+                            directory)
+            os.environ['SETUPTOOLS_GIT_SUBMODULES'] = '1'
+            try:
+                self.assertEqual(len(list(listfiles(top))), 12 + 1 + 1)
+            finally:
+                del os.environ['SETUPTOOLS_GIT_SUBMODULES']
+        finally:
+            rmtree(directory)
@@ -0,0 +1,114 @@
+"""
+Opt-in tracing of where the file finder spends its time.
+
+Set SETUPTOOLS_GIT_TRACE=1 to have a JSON line per phase and a summary
+written to stderr when the process exits, or set it to a file name to
+append them there. Each phase records its duration along with counts
+like the number of paths decoded or directories walked. When tracing
+is off, phase() hands out a shared object that does nothing.
+"""
+import os
+import sys
+import time
+import atexit
+
+__all__ = ['enable', 'disable', 'enabled', 'phase', 'events', 'summary']
+
+events = []
+_target = None
+_registered = False
+
+
+class _Phase(object):
+
+    def __init__(self, name, fields):
+        self.fields = fields
+        self.fields['phase'] = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.fields['seconds'] = time.time() - self.start
+        if exc_info[0] is not None:
+            self.fields['error'] = exc_info[0].__name__
+        events.append(self.fields)
+
+    def update(self, **fields):
+        self.fields.update(fields)
+
+
+class _Disabled(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def update(self, **fields):
+        pass
+
+
+_disabled = _Disabled()
+
+
+def enabled():
+    return _target is not None
+
+
+def phase(name, **fields):
+    # Time a block of code; fields, and those passed to update() on
+    # the result, go into its event
+    if _target is None:
+        return _disabled
+    return _Phase(name, fields)
+
+
+def summary():
+    # Totals per phase
+    res = {}
+    for event in events:
+        total = res.setdefault(event['phase'], {'calls': 0, 'seconds': 0.0})
+        total['calls'] += 1
+        total['seconds'] += event['seconds']
+    return res
+
+
+def _report():
+    if _target is None or not events:
+        return
+    import json
+    from setuptools_git.cache import memo, disk
+    lines = [json.dumps(event, sort_keys=True) for event in events]
+    lines.append(json.dumps({'summary': summary(), 'memo': memo.info(),
+                             'disk': disk.info()}, sort_keys=True))
+    if _target == '1':
+        stream = sys.stderr
+    else:
+        stream = open(_target, 'a')
+    try:
+        stream.write('\n'.join(lines) + '\n')
+    finally:
+        if stream is not sys.stderr:
+            stream.close()
+
+
+def enable(target='1'):
+    # Start recording; target is '1' for stderr or a file name
+    global _target, _registered
+    _target = target
+    if not _registered:
+        atexit.register(_report)
+        _registered = True
+
+
+def disable():
+    global _target
+    _target = None
+    del events[:]
+
+
+if os.environ.get('SETUPTOOLS_GIT_TRACE', '0') not in ('', '0'):
+    enable(os.environ['SETUPTOOLS_GIT_TRACE'])
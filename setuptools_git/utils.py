@@ -1,15 +1,13 @@
 import sys
 import os
 import stat
-import shutil
-import unicodedata
 import posixpath
 
+# Modules only some functions need are imported by those, since every
+# setuptools run loads this plugin
+
 if sys.version_info >= (3,):
-    from urllib.parse import quote as url_quote
     unicode = str
-else:
-    from urllib import quote as url_quote
 
 __all__ = ['check_call', 'check_output', 'rmtree',
            'b', 'posix', 'fsdecode', 'hfs_quote', 'compose', 'decompose']
@@ -74,6 +72,7 @@ except ImportError:
 
 # Windows cannot delete read-only Git objects
 def rmtree(path):
+    import shutil
     if sys.platform == 'win32':
         def onerror(func, path, excinfo):
             os.chmod(path, stat.S_IWRITE)
@@ -116,6 +115,10 @@ def hfs_quote(path):
     try:
         path.decode('utf-8')
     except UnicodeDecodeError:
+        if sys.version_info >= (3,):
+            from urllib.parse import quote as url_quote
+        else:
+            from urllib import quote as url_quote
         path = url_quote(path) # Not UTF-8
         if sys.version_info >= (3,):
             path = path.encode('ascii')
@@ -124,6 +127,7 @@ def hfs_quote(path):
 
 # HFS Plus uses decomposed UTF-8
 def compose(path):
+    import unicodedata
     if isinstance(path, unicode):
         return unicodedata.normalize('NFC', path)
     try:
@@ -137,6 +141,7 @@ def compose(path):
 
 # HFS Plus uses decomposed UTF-8
 def decompose(path):
+    import unicodedata
     if isinstance(path, unicode):
         return unicodedata.normalize('NFD', path)
     try: